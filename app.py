@@ -4,21 +4,39 @@ Run: python app.py
 Visit: http://localhost:5000
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, Response, request, jsonify, send_file
 from flask_cors import CORS
 import os
 import sys
 import numpy as np
 import torch
 import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+from torch.ao.quantization import DeQuantStub, QuantStub, convert, fuse_modules, get_default_qconfig, prepare
 from pathlib import Path
 from datetime import datetime
 import json
 import base64
+import contextlib
+import copy
+import hashlib
+import io
+import queue
+import threading
+import time
+import zipfile
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import matplotlib
 matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+import contourpy
 import pandas as pd
+from PIL import Image, ImageDraw, ImageFont
 
 # Import emission modules
 try:
@@ -32,7 +50,14 @@ except ImportError:
     from yige_code.src.emission.carbon_trading import CarbonTradingCalculator, CarbonTradingReportGenerator
 
 # Flask app
+class UploadRequest(Request):
+    # Keep uploaded files in memory (bounded by MAX_CONTENT_LENGTH) instead of
+    # Werkzeug's temp files, so band arrays are parsed without touching disk
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
 app = Flask(__name__)
+app.request_class = UploadRequest
 CORS(app)
 
 # Folders
@@ -121,18 +146,365 @@ class UNet(nn.Module):
 # Model lazy loading
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 model = None
+_model_lock = threading.Lock()
 
 def load_model():
     global model
-    if model is None:
-        print(f"Loading model from {MODEL_PATH}...")
-        model = UNet(in_channels=24, out_channels=1, base_classes=32)
-        checkpoint = torch.load(MODEL_PATH, map_location=device)
-        model.load_state_dict(checkpoint)
-        model.to(device)
-        model.eval()
-        print("Model loaded successfully!")
+    with _model_lock:
+        if model is None:
+            print(f"Loading model from {MODEL_PATH}...")
+            m = UNet(in_channels=24, out_channels=1, base_classes=32)
+            checkpoint = torch.load(MODEL_PATH, map_location=device)
+            m.load_state_dict(checkpoint)
+            m.to(device)
+            m.eval()
+            m = configure_layout(m)
+            if INFERENCE_MODE == 'int8':
+                m = build_int8_model(m)
+            elif MODEL_OPTIMIZE:
+                m = optimize_model(m)
+            configure_precision(m)
+            model = m
+            print("Model loaded successfully!")
     return model
+
+# Inference layout and precision
+# INFERENCE_LAYOUT=channels_last stores weights and inputs as NHWC, which the CPU
+# convolution kernels handle faster; INFERENCE_PRECISION=bf16 runs the forward pass
+# under bfloat16 autocast. Both are self-checked against the default NCHW fp32 model
+# at load time and fall back when the host does not support them.
+INFERENCE_LAYOUT = os.environ.get('INFERENCE_LAYOUT', 'nchw')
+INFERENCE_PRECISION = os.environ.get('INFERENCE_PRECISION', 'fp32')
+BF16_TOLERANCE = 0.05
+inference_layout = torch.contiguous_format
+inference_dtype = None
+
+def bf16_supported():
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+def inference_context():
+    if inference_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=inference_dtype)
+
+def configure_layout(m):
+    global inference_layout
+    if INFERENCE_LAYOUT != 'channels_last':
+        return m
+    sample = torch.rand(1, 24, TILE_SIZE, TILE_SIZE, device=device)
+    try:
+        with torch.no_grad():
+            reference = m(sample)
+            converted = copy.deepcopy(m).to(memory_format=torch.channels_last)
+            diff = float((converted(sample.contiguous(memory_format=torch.channels_last)) - reference).abs().max())
+    except Exception as e:
+        print(f"channels_last self-check failed ({e}), using NCHW")
+        return m
+    if diff > OPTIMIZE_TOLERANCE:
+        print(f"channels_last output differs by {diff:.2e}, using NCHW")
+        return m
+    inference_layout = torch.channels_last
+    model_info['layout'] = 'channels_last'
+    return converted
+
+def configure_precision(m):
+    global inference_dtype
+    if INFERENCE_PRECISION != 'bf16':
+        return
+    if model_info['mode'] == 'int8':
+        print("bf16 autocast does not apply to the INT8 model, ignoring INFERENCE_PRECISION")
+        return
+    if not bf16_supported():
+        print(f"bfloat16 is not supported on this {device.type}, using fp32")
+        return
+    sample = torch.rand(1, 24, TILE_SIZE, TILE_SIZE, device=device).contiguous(memory_format=inference_layout)
+    try:
+        with torch.no_grad():
+            reference = torch.sigmoid(m(sample))
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+                out = m(sample)
+            diff = float((torch.sigmoid(out.float()) - reference).abs().max())
+    except Exception as e:
+        print(f"bf16 self-check failed ({e}), using fp32")
+        return
+    if diff > BF16_TOLERANCE:
+        print(f"bf16 probabilities differ by {diff:.3f}, using fp32")
+        return
+    print(f"bf16 autocast enabled, max abs probability diff {diff:.4f}")
+    inference_dtype = torch.bfloat16
+    model_info.update({'precision': 'bf16', 'bf16_max_abs_diff': diff})
+
+# Inference graph optimization
+# With MODEL_OPTIMIZE (default on) the fp32 model gets each BatchNorm folded into the
+# preceding convolution and is compiled to a frozen TorchScript graph. The result is
+# checked against the original on a sample batch and discarded if it drifts.
+MODEL_OPTIMIZE = os.environ.get('MODEL_OPTIMIZE', '1').lower() not in ('0', 'false', 'no')
+OPTIMIZE_TOLERANCE = 1e-4
+
+def fold_batchnorm(m):
+    """Copy of a UNet with every DoubleConv BatchNorm folded into its convolution"""
+    folded = copy.deepcopy(m).eval()
+    for block in folded.modules():
+        if isinstance(block, DoubleConv):
+            seq = block.double_conv
+            for conv_idx, bn_idx in ((0, 1), (3, 4)):
+                seq[conv_idx] = fuse_conv_bn_eval(seq[conv_idx], seq[bn_idx])
+                seq[bn_idx] = nn.Identity()
+    return folded
+
+def optimize_model(m):
+    sample = torch.rand(2, 24, TILE_SIZE, TILE_SIZE, device=device)
+    with torch.no_grad():
+        reference = torch.sigmoid(m(sample))
+        optimized = fold_batchnorm(m)
+        steps = 'bn-folded'
+        try:
+            optimized = torch.jit.freeze(torch.jit.script(optimized))
+            steps += '+frozen'
+        except Exception as e:
+            print(f"TorchScript freeze failed ({e}), using the eager folded model")
+        diff = float((torch.sigmoid(optimized(sample)) - reference).abs().max())
+    if diff > OPTIMIZE_TOLERANCE:
+        print(f"Optimized model differs by {diff:.2e}, keeping the original")
+        return m
+    print(f"Model optimized ({steps}), max abs diff {diff:.2e}")
+    model_info.update({'graph': steps, 'optimize_max_abs_diff': diff})
+    return optimized
+
+# Quantized inference
+# INFERENCE_MODE=int8 runs every DoubleConv block (fused Conv-BN-ReLU pairs) with
+# post-training static INT8 quantization on CPU. Pooling, upsampling and the skip
+# concatenations stay in fp32. Calibration uses saved sessions from
+# QUANT_CALIBRATION_DIR; part of them is held out for an IoU/coverage report
+# against the fp32 model, exposed through /api/health.
+INFERENCE_MODE = os.environ.get('INFERENCE_MODE', 'fp32')
+QUANT_CALIBRATION_DIR = Path(os.environ.get('QUANT_CALIBRATION_DIR', UPLOAD_FOLDER))
+QUANT_CALIBRATION_SAMPLES = int(os.environ.get('QUANT_CALIBRATION_SAMPLES', 32))
+QUANT_BACKEND = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'fbgemm'
+model_info = {'mode': 'fp32', 'layout': 'nchw', 'precision': 'fp32'}
+
+class QuantDoubleConv(nn.Module):
+    """DoubleConv with fused Conv-BN-ReLU pairs, quantized between a quant/dequant stub"""
+    def __init__(self, block):
+        super().__init__()
+        self.quant = QuantStub()
+        self.double_conv = fuse_modules(copy.deepcopy(block.double_conv), [['0', '1', '2'], ['3', '4', '5']])
+        self.dequant = DeQuantStub()
+    def forward(self, x):
+        return self.dequant(self.double_conv(self.quant(x)))
+
+def calibration_samples(folder=QUANT_CALIBRATION_DIR, limit=QUANT_CALIBRATION_SAMPLES):
+    """Preprocessed 256x256 inputs from saved sessions, newest first"""
+    samples = []
+    if not folder.is_dir():
+        return samples
+    for session in sorted(folder.iterdir(), reverse=True):
+        paths = [session / f'band_{b}.npy' for b in ('11', '14', '15')]
+        if not all(p.exists() for p in paths):
+            continue
+        try:
+            img, _ = process_data(*[np.load(p, mmap_mode='r') for p in paths])
+        except (OSError, ValueError):
+            continue
+        if img.shape[0] != 24 or min(img.shape[1:]) < TILE_SIZE:
+            continue
+        samples.append(img[:, :TILE_SIZE, :TILE_SIZE])
+        if len(samples) >= limit:
+            break
+    return samples
+
+def quantize_model(fp32, samples):
+    """Static INT8 copy of a UNet, calibrated on a list of (C, H, W) samples"""
+    qm = copy.deepcopy(fp32).cpu().eval()
+    parents = [m for m in qm.modules() if any(isinstance(c, DoubleConv) for c in m.children())]
+    for parent in parents:
+        for name, child in list(parent.named_children()):
+            if isinstance(child, DoubleConv):
+                block = QuantDoubleConv(child)
+                block.qconfig = get_default_qconfig(QUANT_BACKEND)
+                setattr(parent, name, block)
+    torch.backends.quantized.engine = QUANT_BACKEND
+    prepared = prepare(qm)
+    with torch.no_grad():
+        for start in range(0, len(samples), BATCH_MAX_SIZE):
+            prepared(torch.stack(samples[start:start + BATCH_MAX_SIZE]))
+    return convert(prepared)
+
+def quantization_report(reference, candidate, samples, thresh=0.5):
+    """IoU and coverage agreement of a candidate model against the fp32 reference"""
+    ious, coverage_diffs, prob_diffs = [], [], []
+    with torch.no_grad():
+        for img in samples:
+            ref = torch.sigmoid(reference(img[None]))[0, 0].numpy()
+            out = torch.sigmoid(candidate(img[None]))[0, 0].numpy()
+            a, b = ref > thresh, out > thresh
+            union = np.logical_or(a, b).sum()
+            ious.append(float(np.logical_and(a, b).sum() / union) if union else 1.0)
+            coverage_diffs.append(abs(float(a.mean() - b.mean())) * 100)
+            prob_diffs.append(float(np.abs(ref - out).mean()))
+    return {'samples': len(samples), 'mean_iou': round(float(np.mean(ious)), 4), 'min_iou': round(min(ious), 4),
+            'max_coverage_diff': round(max(coverage_diffs), 3), 'mean_abs_prob_diff': round(float(np.mean(prob_diffs)), 5)}
+
+def build_int8_model(fp32):
+    if device.type != 'cpu':
+        print(f"INT8 inference needs CPU, running fp32 on {device}")
+        return fp32
+    samples = calibration_samples()
+    if not samples:
+        print(f"No calibration sessions in {QUANT_CALIBRATION_DIR}, running fp32")
+        return fp32
+    # Hold out a quarter of the sessions for the accuracy report; with too few sessions
+    # for that, the report is measured on the calibration data and flagged as in-sample
+    n_holdout = len(samples) // 4
+    in_sample = n_holdout == 0
+    holdout = samples if in_sample else samples[:n_holdout]
+    calibration = samples[n_holdout:]
+    print(f"Quantizing model to INT8 ({QUANT_BACKEND}) with {len(calibration)} calibration samples...")
+    qm = quantize_model(fp32, calibration)
+    report = {**quantization_report(fp32, qm, holdout), 'in_sample': in_sample}
+    if in_sample:
+        print(f"WARNING: only {len(samples)} calibration sessions (need 4 to hold any out); "
+              f"the INT8 accuracy report below is in-sample")
+    print(f"INT8 vs fp32 on {report['samples']} {'calibration' if in_sample else 'held-out'} samples: "
+          f"mean IoU {report['mean_iou']}, max coverage diff {report['max_coverage_diff']}%")
+    model_info.update({'mode': 'int8', 'backend': QUANT_BACKEND, 'calibration_samples': len(calibration),
+                       'accuracy': report})
+    return qm
+
+# Inference micro-batching
+# Single-scene requests are queued for up to BATCH_WINDOW_MS (or until BATCH_MAX_SIZE
+# scenes are waiting) and run through the UNet as one batch. BATCH_MAX_SIZE=1 disables it.
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 8))
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 10))
+
+def predict(imgs):
+    """Run the UNet on a (N, C, H, W) batch and return (N, H, W) probabilities"""
+    if INFERENCE_SERVER:
+        return inference_client.call('predict', imgs.numpy())
+    m = load_model()
+    with torch.no_grad(), inference_context():
+        out = m(imgs.to(device, memory_format=inference_layout))
+        return torch.sigmoid(out.float()).cpu().numpy()[:, 0]
+
+# Remote inference
+# With INFERENCE_SERVER set to the address of inference_server.py (a unix socket path
+# or host:port), predict() sends tensors to that process, which owns the model and
+# the batching queue, and the web worker never loads the UNet itself.
+INFERENCE_SERVER = os.environ.get('INFERENCE_SERVER')
+INFERENCE_AUTHKEY = os.environ.get('INFERENCE_AUTHKEY', '').encode()
+
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return (host or '127.0.0.1', int(port))
+    return address
+
+def inference_authkey(address):
+    """Shared key for an inference address; TCP needs an explicit key since messages are pickled"""
+    if not isinstance(parse_address(address), str) and not INFERENCE_AUTHKEY:
+        raise RuntimeError(f'INFERENCE_AUTHKEY must be set to use a TCP inference address ({address})')
+    return INFERENCE_AUTHKEY or None
+
+class InferenceClient:
+    """Per-thread connections to the inference server"""
+    def __init__(self, address):
+        self.address = address
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = Client(parse_address(self.address), authkey=inference_authkey(self.address))
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def call(self, op, payload=None):
+        # One reconnect attempt covers a restarted server or a connection left over from fork
+        for attempt in range(2):
+            try:
+                conn = self._conn()
+                conn.send((op, payload))
+                status, result = conn.recv()
+                break
+            except (EOFError, OSError):
+                self.local.conn = None
+                if attempt:
+                    raise
+        if status == 'error':
+            raise RuntimeError(f'Inference server: {result}')
+        return result
+
+if INFERENCE_SERVER:
+    inference_authkey(INFERENCE_SERVER)
+inference_client = InferenceClient(INFERENCE_SERVER) if INFERENCE_SERVER else None
+
+class InferenceBatcher:
+    """Collects pending scenes for a short window and runs them as one forward pass"""
+    def __init__(self, max_size=BATCH_MAX_SIZE, window_ms=BATCH_WINDOW_MS):
+        self.max_size = max_size
+        self.window = window_ms / 1000
+        self.lock = threading.Lock()
+        self.queue = None
+        self.pid = None
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, img):
+        """Queue one (C, H, W) tensor; the returned Future resolves to its (H, W) probability map"""
+        fut = Future()
+        self._ensure_worker().put((img, fut))
+        return fut
+
+    def stats(self):
+        return {'max_size': self.max_size, 'window_ms': self.window * 1000, 'batches': self.batches,
+                'items': self.items, 'avg_batch': round(self.items / self.batches, 2) if self.batches else 0.0}
+
+    def _ensure_worker(self):
+        # Threads do not survive gunicorn's fork, so each worker process starts its own
+        with self.lock:
+            if self.pid != os.getpid():
+                self.queue = queue.Queue()
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, args=(self.queue,), daemon=True, name='inference-batcher').start()
+            return self.queue
+
+    def _run(self, q):
+        while True:
+            items = [q.get()]
+            deadline = time.monotonic() + self.window
+            while len(items) < self.max_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._dispatch(items)
+
+    def _dispatch(self, items):
+        # Scenes of different sizes cannot be stacked, so batch per shape
+        groups = {}
+        for img, fut in items:
+            groups.setdefault(tuple(img.shape), []).append((img, fut))
+        for group in groups.values():
+            try:
+                probs = predict(torch.stack([img for img, _ in group]))
+            except Exception as e:
+                for _, fut in group:
+                    fut.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += len(group)
+            for (_, fut), prob in zip(group, probs):
+                fut.set_result(prob)
+
+batcher = InferenceBatcher()
 emission_calc = EmissionCalculator()
 
 print(f"Model loaded on {device}")
@@ -140,57 +512,621 @@ print("="*60)
 print("MODIFIED VERSION with FIX - Images and Strategies support")
 print("="*60)
 
+# Probability cache
+# Probability maps are keyed by a hash of the three band arrays and the checkpoint,
+# so re-submitting a scene with another threshold or carbon market skips inference.
+# Memory is LRU-bounded by PROB_CACHE_MB; PROB_CACHE_DISK_MB > 0 adds a disk tier.
+PROB_CACHE_MB = float(os.environ.get('PROB_CACHE_MB', 256))
+PROB_CACHE_DISK_MB = float(os.environ.get('PROB_CACHE_DISK_MB', 0))
+CACHE_FOLDER = RESULTS_FOLDER / 'cache'
+_model_version = None
+
+def model_version():
+    global _model_version
+    if _model_version is None:
+        h = hashlib.sha256()
+        with open(MODEL_PATH, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _model_version = h.hexdigest()[:16]
+    return _model_version
+
+def model_identity():
+    """What produced the probability maps: checkpoint, mode and precision. Behind an inference
+    server that is the server's effective setup, not this worker's env."""
+    if INFERENCE_SERVER:
+        return inference_client.call('info')['identity']
+    return f'{model_version()}:{INFERENCE_MODE}:{INFERENCE_PRECISION}'
+
+def scene_key(b11, b14, b15):
+    h = hashlib.sha256(model_identity().encode())
+    for band in (b11, b14, b15):
+        band = np.ascontiguousarray(band)
+        h.update(f'{band.dtype.str}{band.shape}'.encode())
+        h.update(band.data)
+    return h.hexdigest()
+
+class LRUCache:
+    """Thread-safe LRU bounded by the total sizeof() of its values"""
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Cache value unless key is already present, returning the cached one.
+        A value larger than the whole budget is returned without being cached."""
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                return self.entries[key]
+            if size > self.max_size:
+                return value
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, old = self.entries.popitem(last=False)
+                self.size -= self.sizeof(old)
+            return value
+
+    def discard(self, match):
+        """Drop every entry whose key satisfies match(key)"""
+        with self.lock:
+            for key in [k for k in self.entries if match(k)]:
+                self.size -= self.sizeof(self.entries.pop(key))
+
+class ProbabilityCache:
+    """LRU cache of probability maps with an optional on-disk tier"""
+    def __init__(self, max_bytes, disk_folder=None, disk_max_bytes=0):
+        self.memory = LRUCache(max_bytes, sizeof=lambda prob: prob.nbytes)
+        self.disk_folder = disk_folder if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.disk_folder:
+            self.disk_folder.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key):
+        prob = self.memory.get(key)
+        if prob is not None:
+            with self.lock:
+                self.hits += 1
+            return prob
+        if self.disk_folder:
+            path = self.disk_folder / f'{key}.npy'
+            try:
+                prob = np.load(path)
+            except (OSError, ValueError):
+                prob = None
+            if prob is not None:
+                # keep recently used files out of the eviction; another worker may prune it meanwhile
+                with contextlib.suppress(FileNotFoundError):
+                    os.utime(path)
+                self._remember(key, prob)
+                with self.lock:
+                    self.disk_hits += 1
+                return prob
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, prob):
+        prob = np.array(prob, dtype=np.float32)
+        self._remember(key, prob)
+        if self.disk_folder:
+            tmp = self.disk_folder / f'.{key}.{os.getpid()}.{threading.get_ident()}.npy'
+            try:
+                np.save(tmp, prob)
+                os.replace(tmp, self.disk_folder / f'{key}.npy')
+                self._prune_disk()
+            except OSError as e:
+                # the memory tier already holds the map, so a disk-tier failure only costs a future miss
+                tmp.unlink(missing_ok=True)
+                print(f"Probability disk cache write failed: {e}")
+        return prob
+
+    def stats(self):
+        return {'entries': len(self.memory), 'mb': round(self.memory.size / 2**20, 1), 'hits': self.hits,
+                'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def _remember(self, key, prob):
+        prob.setflags(write=False)
+        self.memory.put(key, prob)
+
+    def _prune_disk(self):
+        # Other threads and workers replace and prune the same folder, so files may vanish
+        # at any point; hidden names are in-flight temp files and never pruned
+        files = []
+        for p in self.disk_folder.glob('[!.]*.npy'):
+            with contextlib.suppress(FileNotFoundError):
+                st = p.stat()
+                files.append((st.st_mtime, st.st_size, p))
+        files.sort(key=lambda f: f[0])
+        total = sum(size for _, size, _ in files)
+        for _, size, p in files:
+            if total <= self.disk_max_bytes:
+                break
+            total -= size
+            p.unlink(missing_ok=True)
+
+prob_cache = ProbabilityCache(PROB_CACHE_MB * 2**20, CACHE_FOLDER, PROB_CACHE_DISK_MB * 2**20)
+
 # Helper functions
-def process_data(b11, b14, b15):
-    _T11 = (243, 303)
-    _CLOUD = (-4, 5)
-    _TDIFF = (-4, 2)
-    norm = lambda d, b: (d - b[0]) / (b[1] - b[0])
-    r = norm(b15 - b14, _TDIFF)
-    g = norm(b14 - b11, _CLOUD)
-    b = norm(b14, _T11)
-    fc = np.clip(np.concatenate([r, g, b], axis=2), 0, 1)
-    return torch.tensor(fc).float().permute(2, 0, 1), fc
+# False-color normalization ranges (K): band14, band14 - band11, band15 - band14
+_T11 = (243, 303)
+_CLOUD = (-4, 5)
+_TDIFF = (-4, 2)
+
+def process_data(b11, b14, b15, out=None):
+    """Normalize (H, W, T) bands into the (3T, H, W) float32 model input.
+
+    The channels are written in place into `out` (allocated if not given) through
+    (H, W, T) views, and float16/float32 inputs are computed in float32 without a
+    float64 upcast. Returns the tensor (sharing memory with `out`) and an (H, W, 3T)
+    view of the same buffer for visualization.
+    """
+    h, w, t = b11.shape
+    if out is None:
+        out = np.empty((3 * t, h, w), dtype=np.float32)
+    r, g, b = (out[i * t:(i + 1) * t].transpose(1, 2, 0) for i in range(3))
+    for dst, (x, y), (lo, hi) in ((r, (b15, b14), _TDIFF), (g, (b14, b11), _CLOUD)):
+        np.subtract(x, y, out=dst, dtype=np.float32, casting='same_kind')
+        dst -= lo
+        dst *= 1 / (hi - lo)
+    np.subtract(b14, _T11[0], out=b, dtype=np.float32, casting='same_kind')
+    b *= 1 / (_T11[1] - _T11[0])
+    np.clip(out, 0, 1, out=out)
+    return torch.from_numpy(out), out.transpose(1, 2, 0)
+
+# Clear-scene pre-filter
+# Contrails are cold, thin ice clouds with a positive split-window difference
+# (band14 - band15). When no time step has more than min_fraction of such pixels the
+# scene is treated as contrail-free and the UNet is skipped. Enabled by PREFILTER=1 or
+# per request with config['prefilter'] (true, or a dict overriding the thresholds
+# below: a higher min_fraction or lower btd_threshold skips more, at the cost of recall).
+PREFILTER = os.environ.get('PREFILTER', '0').lower() in ('1', 'true', 'yes')
+PREFILTER_DEFAULTS = {'btd_threshold': 1.0, 'max_bt': 260.0, 'min_fraction': 0.002}
+prefilter_stats = {'checked': 0, 'skipped': 0}
+_prefilter_lock = threading.Lock()
+
+def prefilter_options(config):
+    opt = config.get('prefilter', PREFILTER)
+    if not opt:
+        return None
+    return {**PREFILTER_DEFAULTS, **(opt if isinstance(opt, dict) else {})}
+
+def prescreen(fc, options):
+    """Split-window test on the false-color channels; decides whether inference can be skipped"""
+    # Channels 0-7 hold band15 - band14 scaled from _TDIFF, 16-23 hold band14 scaled from _T11
+    r_max = (-options['btd_threshold'] - _TDIFF[0]) / (_TDIFF[1] - _TDIFF[0])
+    b_max = (options['max_bt'] - _T11[0]) / (_T11[1] - _T11[0])
+    candidates = (fc[:, :, 0:8] <= r_max) & (fc[:, :, 16:24] <= b_max)
+    fraction = float(candidates.mean(axis=(0, 1)).max())
+    skipped = fraction < options['min_fraction']
+    with _prefilter_lock:
+        prefilter_stats['checked'] += 1
+        prefilter_stats['skipped'] += int(skipped)
+    confidence = 1 - fraction / options['min_fraction'] if skipped else 0.0
+    return {'skipped': skipped, 'candidate_fraction': round(fraction, 5), 'confidence': round(confidence, 3)}
+
+# Tiled inference
+# The UNet was trained on 256x256 scenes. Other sizes are split into overlapping
+# tiles, run in batches, and blended back with weights that fall off towards each
+# tile edge so seams between tiles are smoothed out.
+TILE_SIZE = 256
+TILE_OVERLAP = int(os.environ.get('TILE_OVERLAP', 32))
+
+def tile_starts(length, size=TILE_SIZE, overlap=TILE_OVERLAP):
+    stride = size - overlap
+    starts = list(range(0, max(length - size, 0) + 1, stride))
+    if starts[-1] + size < length:
+        starts.append(length - size)
+    return starts
+
+def tile_weight(size=TILE_SIZE, overlap=TILE_OVERLAP):
+    i = np.arange(size) + 0.5
+    ramp = np.minimum(1.0, np.minimum(i, size - i) / max(overlap, 1))
+    return np.outer(ramp, ramp).astype(np.float32)
+
+def blend_tiles(shape, windows, tiles):
+    """Weighted average of overlapping (TILE_SIZE, TILE_SIZE) tile probabilities"""
+    weight = tile_weight()
+    acc = np.zeros(shape, dtype=np.float32)
+    norm = np.zeros(shape, dtype=np.float32)
+    for (y, x), prob in zip(windows, tiles):
+        acc[y:y + TILE_SIZE, x:x + TILE_SIZE] += prob * weight
+        norm[y:y + TILE_SIZE, x:x + TILE_SIZE] += weight
+    return acc / norm
+
+def iter_tile_probs(img, windows):
+    for start in range(0, len(windows), BATCH_MAX_SIZE):
+        chunk = windows[start:start + BATCH_MAX_SIZE]
+        yield from predict(torch.stack([img[:, y:y + TILE_SIZE, x:x + TILE_SIZE] for y, x in chunk]))
+
+def predict_tiled(img):
+    """Probability map for a (C, H, W) scene of any size from overlapping TILE_SIZE tiles"""
+    _, h, w = img.shape
+    ph, pw = max(h, TILE_SIZE), max(w, TILE_SIZE)
+    if (ph, pw) != (h, w):
+        img = nn.functional.pad(img.unsqueeze(0), (0, pw - w, 0, ph - h), mode='replicate')[0]
+
+    windows = [(y, x) for y in tile_starts(ph) for x in tile_starts(pw)]
+    if SCENE_WORKERS > 0 and len(windows) >= SCENE_MIN_TILES and not INFERENCE_SERVER:
+        prob = scene_engine.run(img, windows)
+    else:
+        prob = blend_tiles((ph, pw), windows, iter_tile_probs(img, windows))
+    return prob[:h, :w]
+
+# Parallel scene engine
+# With SCENE_WORKERS > 0, scenes of at least SCENE_MIN_TILES tiles are sharded across
+# a pool of worker processes that each load their own UNet. The padded input and the
+# per-tile outputs live in shared memory, so only tile coordinates are pickled.
+SCENE_WORKERS = int(os.environ.get('SCENE_WORKERS', 0))
+SCENE_MIN_TILES = int(os.environ.get('SCENE_MIN_TILES', 8))
+
+class SpawnPool:
+    """Spawn-context ProcessPoolExecutor, created on first use in each process"""
+    def __init__(self, workers, initializer=None, initargs=()):
+        self.workers = workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        # Pools are per process; a pool created before a fork is unusable in the child
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=self.initializer, initargs=self.initargs)
+                self.pid = os.getpid()
+            return self.pool
+
+    def reset(self, pool):
+        """Drop a broken pool so the next get() builds a fresh one"""
+        with self.lock:
+            if self.pool is pool:
+                self.pool, self.pid = None, None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _attach_shm(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13; the spawn children share the parent's resource tracker
+        return shared_memory.SharedMemory(name=name)
+
+def _scene_worker_init(threads):
+    torch.set_num_threads(threads)
+    load_model()
+
+def _scene_worker_run(in_name, in_shape, out_name, n_tiles, shard):
+    """Predict a shard of (slot, y, x) tiles from shared memory into their output slots"""
+    shm_in, shm_out = _attach_shm(in_name), _attach_shm(out_name)
+    try:
+        img = torch.from_numpy(np.ndarray(in_shape, dtype=np.float32, buffer=shm_in.buf))
+        out = np.ndarray((n_tiles, TILE_SIZE, TILE_SIZE), dtype=np.float32, buffer=shm_out.buf)
+        slots = [slot for slot, _, _ in shard]
+        for slot, prob in zip(slots, iter_tile_probs(img, [(y, x) for _, y, x in shard])):
+            out[slot] = prob
+        del img, out  # release the buffer views before closing
+    finally:
+        shm_in.close()
+        shm_out.close()
+    return len(shard)
+
+class SceneEngine:
+    """Process pool that runs the tiles of one large scene in parallel"""
+    def __init__(self, workers=SCENE_WORKERS):
+        self.workers = workers
+        threads = max(1, (os.cpu_count() or 1) // max(1, workers))
+        self.pool = SpawnPool(workers, _scene_worker_init, (threads,))
+
+    def run(self, img, windows):
+        """Blended probability map for a padded (C, H, W) tensor and its tile windows"""
+        # A worker that dies (e.g. OOM-killed) breaks the whole executor; rebuild it once
+        for attempt in range(2):
+            pool = self.pool.get()
+            try:
+                return self._run(pool, img, windows)
+            except BrokenProcessPool:
+                self.pool.reset(pool)
+                if attempt:
+                    raise
+
+    def _run(self, pool, img, windows):
+        shape = tuple(img.shape)
+        n_tiles = len(windows)
+        shm_in = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        shm_out = shared_memory.SharedMemory(create=True, size=n_tiles * TILE_SIZE * TILE_SIZE * 4)
+        try:
+            np.ndarray(shape, dtype=np.float32, buffer=shm_in.buf)[:] = img.numpy()
+            # Contiguous shards keep each worker's tiles spatially close together
+            slots = [(i, y, x) for i, (y, x) in enumerate(windows)]
+            n_shards = min(n_tiles, self.workers * 4)
+            bounds = np.linspace(0, n_tiles, n_shards + 1).astype(int)
+            futures = [pool.submit(_scene_worker_run, shm_in.name, shape, shm_out.name, n_tiles, slots[lo:hi])
+                       for lo, hi in zip(bounds[:-1], bounds[1:]) if hi > lo]
+            for fut in futures:
+                fut.result()
+            tiles = np.ndarray((n_tiles, TILE_SIZE, TILE_SIZE), dtype=np.float32, buffer=shm_out.buf)
+            prob = blend_tiles(shape[1:], windows, tiles)
+            del tiles
+            return prob
+        finally:
+            shm_in.close()
+            shm_in.unlink()
+            shm_out.close()
+            shm_out.unlink()
+
+scene_engine = SceneEngine()
 
 def detect(img, thresh=0.5):
-    m = load_model()  # Load model on first use
-    with torch.no_grad():
-        img = img.unsqueeze(0).to(device) if img.dim() == 3 else img.to(device)
-        out = m(img)
-        prob = torch.sigmoid(out).cpu().numpy()[0, 0]
-        binary = (prob > thresh).astype(np.uint8)
+    """(C, H, W) scene -> (H, W) probability and mask; an (N, C, H, W) batch gives (N, H, W) arrays"""
+    if img.dim() == 4:
+        prob = np.stack(predict_many(list(img)))
+    elif tuple(img.shape[-2:]) != (TILE_SIZE, TILE_SIZE):
+        prob = predict_tiled(img)
+    elif BATCH_MAX_SIZE > 1 and not INFERENCE_SERVER:
+        prob = batcher.submit(img).result()
+    else:
+        prob = predict(img.unsqueeze(0))[0]
+    binary = (prob > thresh).astype(np.uint8)
     return prob, binary
 
-def save_single_image(data, path, title, cmap=None):
+def detect_cached(key, img, thresh=0.5):
+    """detect() backed by the probability cache; only thresholding reruns on a hit"""
+    prob = prob_cache.get(key)
+    if prob is None:
+        prob = prob_cache.put(key, detect(img)[0])
+    return prob, (prob > thresh).astype(np.uint8)
+
+def predict_many(imgs):
+    """Run a list of (C, H, W) tensors through the UNet in batches of BATCH_MAX_SIZE"""
+    probs = [None] * len(imgs)
+    groups = {}
+    for i, img in enumerate(imgs):
+        if tuple(img.shape[-2:]) != (TILE_SIZE, TILE_SIZE):
+            probs[i] = predict_tiled(img)
+            continue
+        groups.setdefault(tuple(img.shape), []).append(i)
+    for idx in groups.values():
+        for start in range(0, len(idx), BATCH_MAX_SIZE):
+            chunk = idx[start:start + BATCH_MAX_SIZE]
+            for i, prob in zip(chunk, predict(torch.stack([imgs[i] for i in chunk]))):
+                probs[i] = prob
+    return probs
+
+# Parallel rendering
+# The analysis images are rendered concurrently on render_executor while emission and
+# strategies are computed. Figures use the object-oriented matplotlib API (no pyplot
+# state), so they need no lock; matplotlib holds the GIL for most of a render though,
+# so RENDER_PROCESSES > 0 moves figures into spawned processes instead.
+RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', 4))
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', 0))
+render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='render')
+
+class FigurePool:
+    """Spawned process pool for matplotlib figures"""
+    def __init__(self, workers=RENDER_PROCESSES):
+        self.workers = workers
+        self.pool = SpawnPool(workers)
+
+    def render(self, fn, *args):
+        """Run fn(*args) in the pool if enabled, else in the calling thread"""
+        if not self.workers:
+            return fn(*args)
+        return self.pool.get().submit(fn, *args).result()
+
+figure_pool = FigurePool()
+
+# Fast image rendering
+# Colormaps are sampled once into 256-entry lookup tables, so a render is a NumPy
+# table lookup plus a Pillow PNG encode, with no pyplot state involved.
+# RENDERER=matplotlib (or config['renderer']) switches back to the matplotlib figures.
+RENDERER = os.environ.get('RENDERER', 'fast')
+RENDER_MIN_SIZE = 768
+_colormap_luts = {}
+_fonts = {}
+
+# Image profiles
+# config['image_profile'] picks the output size: thumbnails and previews fit within
+# `size` pixels, while 'full' keeps the print-quality dpi=200 figures. config['image_format']
+# is 'png' (config['png_compression'] 0-9) or 'webp' (config['image_quality'] 1-100 or 'lossless').
+IMAGE_PROFILES = {
+    'thumbnail': {'size': 256, 'dpi': 72},
+    'preview': {'size': 800, 'dpi': 100},
+    'full': {'size': None, 'dpi': 200},
+}
+IMAGE_PROFILE = os.environ.get('IMAGE_PROFILE', 'full')
+IMAGE_FORMATS = ('png', 'webp')
+
+def image_options(config):
+    """Validated output options for the images of a request"""
+    config = config or {}
+    profile = config.get('image_profile', IMAGE_PROFILE)
+    if profile not in IMAGE_PROFILES:
+        raise ValueError(f'Unknown image profile {profile!r}, expected one of {list(IMAGE_PROFILES)}')
+    fmt = str(config.get('image_format', 'png')).lower()
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f'Unknown image format {fmt!r}, expected one of {list(IMAGE_FORMATS)}')
+    options = {'profile': profile, 'format': fmt, **IMAGE_PROFILES[profile]}
+    if fmt == 'webp':
+        quality = config.get('image_quality', 80)
+        if quality != 'lossless' and not 1 <= int(quality) <= 100:
+            raise ValueError(f'image_quality must be 1-100 or "lossless", got {quality!r}')
+        options['quality'] = quality if quality == 'lossless' else int(quality)
+    else:
+        level = int(config.get('png_compression', 6))
+        if not 0 <= level <= 9:
+            raise ValueError(f'png_compression must be 0-9, got {level}')
+        options['compression'] = level
+    return options
+
+def image_filename(kind, options):
+    """Default full-quality PNGs keep their plain <kind>.png name; other variants are cached side by side"""
+    if options['format'] == 'png':
+        if options['profile'] == 'full' and options['compression'] == 6:
+            return f'{kind}.png'
+        return f"{kind}.{options['profile']}.z{options['compression']}.png"
+    tag = 'lossless' if options['quality'] == 'lossless' else f"q{options['quality']}"
+    return f"{kind}.{options['profile']}.{tag}.webp"
+
+def encoder_args(options):
+    """Pillow format name and save() keyword arguments for the options"""
+    if options['format'] == 'webp':
+        if options['quality'] == 'lossless':
+            return 'WEBP', {'lossless': True}
+        return 'WEBP', {'quality': options['quality']}
+    return 'PNG', {'compress_level': options['compression']}
+
+def colormap_lut(name):
+    if name not in _colormap_luts:
+        colors = matplotlib.colormaps[name](np.linspace(0, 1, 256))[:, :3]
+        _colormap_luts[name] = np.round(colors * 255).astype(np.uint8)
+    return _colormap_luts[name]
+
+for _name in ('hot', 'gray'):
+    colormap_lut(_name)
+
+def get_font(size, bold=False):
+    key = (size, bold)
+    if key not in _fonts:
+        try:
+            _fonts[key] = ImageFont.truetype('DejaVuSans-Bold.ttf' if bold else 'DejaVuSans.ttf', size)
+        except OSError:
+            try:
+                _fonts[key] = ImageFont.load_default(size=size)
+            except TypeError:  # Pillow < 10.1 has no sized default font
+                _fonts[key] = ImageFont.load_default()
+    return _fonts[key]
+
+def colorize(data, cmap=None):
+    """Map a 2-D array through a colormap (min/max scaled, like imshow) or an RGB float image to uint8"""
+    if cmap is None:
+        return np.round(np.clip(data, 0, 1) * 255).astype(np.uint8)
+    lo, hi = float(np.min(data)), float(np.max(data))
+    scale = 255 / (hi - lo) if hi > lo else 0.0
+    idx = np.clip((data - lo) * scale, 0, 255).astype(np.uint8)
+    return colormap_lut(cmap)[idx]
+
+def render_png(data, path, title, cmap=None, colorbar=True, options=None):
+    """Render an array to a titled image (with an optional colorbar strip) without matplotlib"""
+    options = options or image_options(None)
+    rgb = colorize(data, cmap)
+    h, w = rgb.shape[:2]
+    if options['size']:
+        pad, title_h = 20, 70
+        bar_w = 110 if cmap and colorbar else 0
+        # Largest whole zoom that fits the profile, so the pixels never need resampling
+        scale = max(1, -(-RENDER_MIN_SIZE // max(h, w)))
+        scale = max(1, min(scale, (options['size'] - 2 * pad - bar_w) // w, (options['size'] - title_h - pad) // h))
+    else:
+        # Print quality: the image spans the same 8 in at options['dpi'] as the matplotlib figure
+        scale = max(1, round(8 * options['dpi'] / max(h, w)))
+    # Title, padding and colorbar grow with the image so they keep their proportions
+    u = max(1, scale * max(h, w) // RENDER_MIN_SIZE)
+    pad, title_h = 20 * u, 70 * u
+    bar_w = 110 * u if cmap and colorbar else 0
+    img = Image.fromarray(rgb).resize((w * scale, h * scale), Image.NEAREST)
+    canvas = Image.new('RGB', (img.width + 2 * pad + bar_w, img.height + title_h + pad), 'white')
+    canvas.paste(img, (pad, title_h))
+    draw = ImageDraw.Draw(canvas)
+
+    font = get_font(30 * u, bold=True)
+    tw = draw.textlength(title, font=font)
+    draw.text(((canvas.width - tw) / 2, 20 * u), title, fill='black', font=font)
+
+    if bar_w:
+        # Vertical gradient, max at the top, labelled with the data range
+        x0 = pad + img.width + 20 * u
+        gradient = colormap_lut(cmap)[np.linspace(255, 0, img.height).astype(np.uint8)]
+        strip = np.repeat(gradient[:, None, :], 24 * u, axis=1)
+        canvas.paste(Image.fromarray(strip), (x0, title_h))
+        draw.rectangle([x0, title_h, x0 + 24 * u - 1, title_h + img.height - 1], outline='black', width=u)
+        small = get_font(18 * u)
+        lo, hi = float(np.min(data)), float(np.max(data))
+        draw.text((x0 + 30 * u, title_h), f'{hi:.2f}', fill='black', font=small)
+        draw.text((x0 + 30 * u, title_h + img.height - 20 * u), f'{lo:.2f}', fill='black', font=small)
+
+    if options['size'] and max(canvas.size) > options['size']:
+        canvas.thumbnail((options['size'], options['size']), Image.LANCZOS)
+    fmt, kwargs = encoder_args(options)
+    canvas.save(path, format=fmt, **kwargs)
+
+def save_single_image(data, path, title, cmap=None, renderer=None, options=None):
     """Save a single visualization image"""
-    fig, ax = plt.subplots(1, 1, figsize=(8, 8))
+    options = options or image_options(None)
+    if (renderer or RENDERER) == 'matplotlib':
+        figure_pool.render(_save_single_image, data, path, title, cmap, options)
+    else:
+        render_png(data, path, title, cmap, options=options)
+
+def save_figure(fig, path, options, **kwargs):
+    """Save a figure at the profile's size (longest side of the figure) or dpi"""
+    fmt, pil_kwargs = encoder_args(options)
+    dpi = options['size'] / max(fig.get_size_inches()) if options['size'] else options['dpi']
+    fig.savefig(path, format=fmt.lower(), dpi=dpi, bbox_inches='tight', pil_kwargs=pil_kwargs, **kwargs)
+
+def _save_single_image(data, path, title, cmap=None, options=None):
+    fig = Figure(figsize=(8, 8))
+    ax = fig.subplots(1, 1)
     if cmap:
         im = ax.imshow(data, cmap=cmap)
-        plt.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
+        fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04)
     else:
         ax.imshow(data)
     ax.set_title(title, fontsize=16, fontweight='bold', pad=15)
     ax.axis('off')
-    plt.tight_layout()
-    plt.savefig(path, dpi=200, bbox_inches='tight', facecolor='white')
-    plt.close()
+    fig.tight_layout()
+    save_figure(fig, path, options or image_options(None), facecolor='white')
+
+def input_rgb(fc, t=3):
+    return np.stack([fc[:, :, t], fc[:, :, 8 + t], fc[:, :, 16 + t]], axis=2)
+
+def render_image(kind, fc, prob, binary, config, folder):
+    """Render one visualization image into the session folder and return its path"""
+    options = image_options(config)
+    path = folder / image_filename(kind, options)
+    renderer = (config or {}).get('renderer')
+    if kind == 'input':
+        save_single_image(input_rgb(fc), path, 'Satellite Input Image', renderer=renderer, options=options)
+    elif kind == 'probability':
+        save_single_image(prob, path, 'Contrail Probability Map', cmap='hot', renderer=renderer, options=options)
+    elif kind == 'binary':
+        save_single_image(binary, path, 'Binary Detection Result', cmap='gray', renderer=renderer, options=options)
+    elif kind == 'fusion':
+        visualize_fusion(input_rgb(fc), binary, config, path, options)
+    else:
+        raise ValueError(f'Unknown image kind: {kind}')
+    return path
 
 def visualize(fc, prob, binary, folder):
     """Generate individual visualization images"""
-    t = 3
-    rgb = np.stack([fc[:, :, t], fc[:, :, 8 + t], fc[:, :, 16 + t]], axis=2)
+    for kind in ('input', 'probability', 'binary'):
+        render_image(kind, fc, prob, binary, None, folder)
 
-    # Save individual images
-    save_single_image(rgb, folder / 'input.png', 'Satellite Input Image')
-    save_single_image(prob, folder / 'probability.png', 'Contrail Probability Map', cmap='hot')
-    save_single_image(binary, folder / 'binary.png', 'Binary Detection Result', cmap='gray')
-
-def visualize_fusion(fc, binary, config, path):
+def visualize_fusion(rgb, binary, config, path, options=None):
     """Generate fusion visualization of contrail detection and flight track"""
-    t = 3
-    rgb = np.stack([fc[:, :, t], fc[:, :, 8 + t], fc[:, :, 16 + t]], axis=2)
+    figure_pool.render(_visualize_fusion, rgb, binary, config, path, options or image_options(config))
 
-    fig, ax = plt.subplots(1, 1, figsize=(10, 10))
+def _visualize_fusion(rgb, binary, config, path, options):
+    fig = Figure(figsize=(10, 10))
+    ax = fig.subplots(1, 1)
 
     # Show satellite image
     ax.imshow(rgb, alpha=0.8)
@@ -236,9 +1172,8 @@ def visualize_fusion(fc, binary, config, path):
                  fontsize=16, fontweight='bold', pad=20)
     ax.axis('off')
 
-    plt.tight_layout()
-    plt.savefig(path, dpi=200, bbox_inches='tight')
-    plt.close()
+    fig.tight_layout()
+    save_figure(fig, path, options)
 
 def calc_emission(config, mask):
     track = pd.DataFrame({
@@ -253,6 +1188,790 @@ def calc_emission(config, mask):
     cb = ct.calculate_flight_carbon_cost(em.co2_total, em.flight_distance, 180)
     return em, cb
 
+def contrail_stats(prob, binary):
+    pixels = int(np.sum(binary))
+    coverage = float(pixels / binary.size * 100)
+    area = float(pixels * 4)
+    intensity = float(np.mean(prob[binary > 0])) if pixels > 0 else 0.0
+    return {'pixels': pixels, 'coverage': round(coverage, 2), 'area': round(area, 1), 'intensity': round(intensity, 2)}
+
+def emission_summary(config, em, cb):
+    """Emission, carbon cost and flight sections of an analysis response"""
+    return {
+        'emission': {'distance': round(em.flight_distance, 1), 'fuel': round(em.fuel_burn, 1),
+                    'co2_direct': round(em.co2_direct, 1), 'co2_contrail': round(em.co2_contrail, 1),
+                    'co2_total': round(em.co2_total, 1)},
+        'carbon': {'market': config.get('carbon_market', 'EU_ETS'), 'price': cb.carbon_price_per_tonne,
+                  'cost_total': round(cb.carbon_cost_total, 2), 'cost_per_km': round(cb.carbon_cost_per_km, 4),
+                  'cost_per_passenger': round(cb.carbon_cost_per_passenger, 2)},
+        'flight': {'callsign': config.get('flight_callsign', 'UNKNOWN'), 'aircraft': 'A320',
+                  'time': config.get('detection_time', datetime.now().isoformat())},
+    }
+
+def carbon_strategies(em):
+    """Carbon cost of the flight across markets and cruise altitudes"""
+    markets = ['EU_ETS', 'CORSIA', 'CHINA', 'UK_ETS', 'CALIFORNIA']
+    altitudes = [8000, 9000, 10000, 11000, 12000]  # meters
+
+    strategies = []
+    for market in markets:
+        ct = CarbonTradingCalculator(market)
+        market_data = {'market': market, 'price': ct.carbon_price, 'altitudes': []}
+
+        for alt in altitudes:
+            # Simulate altitude impact (higher altitude = more contrail, more CO2eq)
+            altitude_factor = 1.0 + (alt - 10000) / 10000 * 0.3
+            adjusted_co2 = em.co2_total * altitude_factor
+            cost_result = ct.calculate_flight_carbon_cost(adjusted_co2, em.flight_distance, 180)
+
+            market_data['altitudes'].append({
+                'altitude': alt,
+                'co2_total': round(adjusted_co2, 1),
+                'cost_total': round(cost_result.carbon_cost_total, 2),
+                'cost_per_km': round(cost_result.carbon_cost_per_km, 4)
+            })
+
+        strategies.append(market_data)
+    return strategies
+
+def encode_image(path):
+    with open(path, 'rb') as f:
+        return base64.b64encode(f.read()).decode()
+
+# Mask encodings
+# Machine-readable forms of the masks, so clients can draw overlays and analytics can
+# consume pixels without decoding PNGs. Selected with config['mask_encodings'].
+MASK_ENCODINGS = ('rle', 'bitpack', 'polygons')
+
+def mask_options(config):
+    """Validated list of requested encodings, empty when none were asked for"""
+    encodings = config.get('mask_encodings') or []
+    if isinstance(encodings, str):
+        encodings = [encodings]
+    unknown = [e for e in encodings if e not in MASK_ENCODINGS]
+    if unknown:
+        raise ValueError(f'Unknown mask encodings {unknown}, expected some of {list(MASK_ENCODINGS)}')
+    return list(encodings)
+
+def rle_encode(mask):
+    """Row-major run lengths, alternating 0-runs and 1-runs and starting with a 0-run"""
+    flat = mask.ravel()
+    bounds = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]))
+    counts = np.diff(bounds)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.tolist()
+
+def simplify_line(points, tolerance):
+    """Douglas-Peucker simplification of an (N, 2) polyline"""
+    if len(points) < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        d = points[j] - points[i]
+        seg = points[i + 1:j] - points[i]
+        norm = np.hypot(d[0], d[1])
+        # closed rings start and end on the same point, so fall back to plain distance
+        dist = np.abs(d[0] * seg[:, 1] - d[1] * seg[:, 0]) / norm if norm else np.hypot(seg[:, 0], seg[:, 1])
+        k = int(np.argmax(dist))
+        if dist[k] > tolerance:
+            keep[i + 1 + k] = True
+            stack += [(i, i + 1 + k), (i + 1 + k, j)]
+    return points[keep]
+
+def mask_polygons(mask, tolerance=1.0):
+    """Closed [x, y] rings in pixel coordinates around the mask regions (holes included;
+    fill them with the even-odd rule)"""
+    padded = np.pad(mask.astype(np.float32), 1)
+    rings = []
+    for line in contourpy.contour_generator(z=padded, line_type='Separate', corner_mask=False).lines(0.5):
+        ring = simplify_line(line - 1, tolerance)
+        if len(ring) < 4:
+            ring = line - 1
+        rings.append(np.round(ring, 1).tolist())
+    return rings
+
+def encode_mask(mask, encodings, tolerance=1.0):
+    mask = mask.astype(bool)
+    encoded = {'shape': list(mask.shape)}
+    if 'rle' in encodings:
+        encoded['rle'] = rle_encode(mask)
+    if 'bitpack' in encodings:
+        encoded['bitpack'] = base64.b64encode(np.packbits(mask.ravel()).tobytes()).decode()
+    if 'polygons' in encodings:
+        encoded['polygons'] = mask_polygons(mask, tolerance)
+    return encoded
+
+def mask_summary(prob, binary, config, encodings):
+    """Encoded binary mask plus one encoded mask per extra probability level in config['mask_levels']"""
+    tolerance = config.get('polygon_tolerance', 1.0)
+    masks = {'binary': encode_mask(binary, encodings, tolerance)}
+    levels = config.get('mask_levels') or []
+    if levels:
+        masks['levels'] = [{'threshold': level, **encode_mask(prob > level, encodings, tolerance)} for level in levels]
+    return masks
+
+# Upload parsing
+# .npy uploads are parsed straight from the request stream into memory. When raw
+# inputs are persisted (PERSIST_UPLOADS, or config['persist_inputs']) the array is
+# read directly into a memory-mapped band_XX.npy, so persistence costs no second
+# pass and the write-back to disk is left to the OS page cache.
+PERSIST_UPLOADS = os.environ.get('PERSIST_UPLOADS', '1').lower() not in ('0', 'false', 'no')
+
+def read_npy(stream, persist_path=None):
+    """Read one .npy array from a file-like stream, optionally into a memory-mapped file"""
+    version = np.lib.format.read_magic(stream)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+    elif version in ((2, 0), (3, 0)):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+    else:
+        raise ValueError(f'Unsupported .npy format version {version}')
+    if dtype.hasobject:
+        raise ValueError('Object arrays are not accepted')
+
+    order = 'F' if fortran_order else 'C'
+    if persist_path is None:
+        arr = np.empty(shape, dtype=dtype, order=order)
+        _read_into(stream, arr)
+        return arr
+    # Fill a temp file and move it into place only once complete, so a failed upload
+    # never leaves a zero-filled band_XX.npy behind for SceneStore or calibration
+    persist_path = Path(persist_path)
+    tmp = persist_path.with_name(f'.{persist_path.stem}.{os.getpid()}.{threading.get_ident()}.npy')
+    try:
+        arr = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape, fortran_order=fortran_order)
+        _read_into(stream, arr)
+        arr.flush()
+        os.replace(tmp, persist_path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return arr
+
+def _read_into(stream, arr):
+    buf = memoryview(arr.reshape(-1, order='A')).cast('B') if arr.size else memoryview(b'')
+    filled = 0
+    while filled < len(buf):
+        n = stream.readinto(buf[filled:])
+        if not n:
+            raise ValueError(f'Truncated .npy upload: expected {len(buf)} bytes, got {filled}')
+        filled += n
+
+def read_band(stream, persist_path=None):
+    """Read a band from an .npy or compressed .npz upload; float16 payloads stay float16"""
+    head = stream.read(4)
+    stream.seek(0)
+    if head != b'PK\x03\x04':
+        return read_npy(stream, persist_path)
+    with np.load(stream) as npz:
+        names = npz.files
+        key = names[0] if len(names) == 1 else next((k for k in ('band', 'data', 'arr_0') if k in names), None)
+        if key is None:
+            raise ValueError(f'Cannot tell which array in the .npz is the band: {names}')
+        arr = npz[key]
+    if persist_path is not None:
+        np.save(persist_path, arr)
+    return arr
+
+def read_upload_bands(files, folder, config):
+    """band11/band14/band15 arrays from the request files, persisted into folder if enabled.
+    Accepts three band files (.npy or .npz) or one 'scene' .npz holding band11/band14/band15."""
+    persist = config.get('persist_inputs', PERSIST_UPLOADS)
+    if 'scene' in files:
+        with np.load(files['scene'].stream) as npz:
+            bands = [npz[f'band{b}'] for b in ('11', '14', '15')]
+        if persist:
+            for b, arr in zip(('11', '14', '15'), bands):
+                np.save(folder / f'band_{b}.npy', arr)
+        return bands
+    return [read_band(files[f'band{b}'].stream, folder / f'band_{b}.npy' if persist else None)
+            for b in ('11', '14', '15')]
+
+# Chunked scenes
+# Scenes too large for one upload are stored as a grid of (chunk, chunk, T) .npy
+# files per band (meta.json records shape, dtype and chunk size). Chunks can be
+# uploaded one by one, and tiled inference reads only the chunks under each tile.
+class ChunkStore:
+    """(H, W, T) band array kept on disk as a grid of chunk files"""
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'meta.json', 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        self.shape = tuple(meta['shape'])
+        self.dtype = np.dtype(meta['dtype'])
+        self.chunk = meta['chunk']
+        self.grid = (-(-self.shape[0] // self.chunk), -(-self.shape[1] // self.chunk))
+
+    @classmethod
+    def create(cls, path, shape, dtype='float32', chunk=TILE_SIZE):
+        if len(shape) != 3:
+            raise ValueError(f'Band shape must be (H, W, T), got {shape}')
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        with open(path / 'meta.json', 'w', encoding='utf-8') as f:
+            json.dump({'shape': list(shape), 'dtype': np.dtype(dtype).str, 'chunk': int(chunk)}, f)
+        return cls(path)
+
+    @classmethod
+    def from_array(cls, path, arr, chunk=TILE_SIZE):
+        store = cls.create(path, arr.shape, arr.dtype, chunk)
+        for cy, cx in store.chunk_ids():
+            y0, y1, x0, x1 = store.chunk_bounds(cy, cx)
+            store.write_chunk(cy, cx, arr[y0:y1, x0:x1])
+        return store
+
+    def chunk_ids(self):
+        return [(cy, cx) for cy in range(self.grid[0]) for cx in range(self.grid[1])]
+
+    def chunk_bounds(self, cy, cx):
+        c = self.chunk
+        return cy * c, min((cy + 1) * c, self.shape[0]), cx * c, min((cx + 1) * c, self.shape[1])
+
+    def chunk_path(self, cy, cx):
+        return self.path / f'{cy}.{cx}.npy'
+
+    def write_chunk(self, cy, cx, data):
+        if not (0 <= cy < self.grid[0] and 0 <= cx < self.grid[1]):
+            raise ValueError(f'Chunk ({cy}, {cx}) is outside the {self.grid} grid')
+        y0, y1, x0, x1 = self.chunk_bounds(cy, cx)
+        expected = (y1 - y0, x1 - x0, self.shape[2])
+        if data.shape != expected:
+            raise ValueError(f'Chunk ({cy}, {cx}) must have shape {expected}, got {data.shape}')
+        tmp = self.path / f'.{cy}.{cx}.{os.getpid()}.{threading.get_ident()}.npy'
+        np.save(tmp, data.astype(self.dtype, copy=False))
+        os.replace(tmp, self.chunk_path(cy, cx))
+
+    def missing(self):
+        return [ids for ids in self.chunk_ids() if not self.chunk_path(*ids).exists()]
+
+    def read(self, y0, y1, x0, x1, t=None):
+        """Region [y0:y1, x0:x1] (optionally a single time step t) assembled from memory-mapped chunks"""
+        c = self.chunk
+        out = np.empty((y1 - y0, x1 - x0) + ((self.shape[2],) if t is None else ()), dtype=self.dtype)
+        for cy in range(y0 // c, (y1 - 1) // c + 1):
+            for cx in range(x0 // c, (x1 - 1) // c + 1):
+                cy0, cy1, cx0, cx1 = self.chunk_bounds(cy, cx)
+                sy0, sy1, sx0, sx1 = max(y0, cy0), min(y1, cy1), max(x0, cx0), min(x1, cx1)
+                src = np.load(self.chunk_path(cy, cx), mmap_mode='r')[sy0 - cy0:sy1 - cy0, sx0 - cx0:sx1 - cx0]
+                out[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = src if t is None else src[:, :, t]
+        return out
+
+def scene_stores(folder):
+    return [ChunkStore(folder / f'band_{b}') for b in ('11', '14', '15')]
+
+def predict_stores(stores):
+    """Tiled inference over chunked bands, holding only one batch of tiles in memory"""
+    h, w, t = stores[0].shape
+    ph, pw = max(h, TILE_SIZE), max(w, TILE_SIZE)
+    windows = [(y, x) for y in tile_starts(ph) for x in tile_starts(pw)]
+
+    def tile_probs():
+        for start in range(0, len(windows), BATCH_MAX_SIZE):
+            chunk = windows[start:start + BATCH_MAX_SIZE]
+            batch = np.empty((len(chunk), 3 * t, TILE_SIZE, TILE_SIZE), dtype=np.float32)
+            for k, (y, x) in enumerate(chunk):
+                regions = [s.read(y, min(y + TILE_SIZE, h), x, min(x + TILE_SIZE, w)) for s in stores]
+                if regions[0].shape[:2] != (TILE_SIZE, TILE_SIZE):
+                    pad = ((0, TILE_SIZE - regions[0].shape[0]), (0, TILE_SIZE - regions[0].shape[1]), (0, 0))
+                    regions = [np.pad(r, pad, mode='edge') for r in regions]
+                process_data(*regions, out=batch[k])
+            yield from predict(torch.from_numpy(batch))
+
+    return blend_tiles((ph, pw), windows, tile_probs())[:h, :w]
+
+# Session arrays
+# The arrays behind every image are kept in the session folder so images can be
+# (re)rendered on demand instead of always being embedded in the analyze response.
+IMAGE_MAX_AGE = 24 * 3600
+_render_locks = {}
+_render_locks_guard = threading.Lock()
+
+def save_session_arrays(folder, rgb, prob, binary, config):
+    # Each file is written under a temp name and swapped in: tile pyramids memory-map the
+    # arrays and image renders read them, so a re-analysis must never truncate them in place
+    suffix = f'{os.getpid()}.{threading.get_ident()}'
+    for name, arr in (('input_rgb', rgb.astype(np.float32)), ('binary', binary.astype(np.uint8)),
+                      ('prob', prob.astype(np.float32))):
+        tmp = folder / f'.{name}.{suffix}.npy'
+        np.save(tmp, arr)
+        os.replace(tmp, folder / f'{name}.npy')
+    tmp = folder / f'.config.{suffix}.json'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(config, f)
+    os.replace(tmp, folder / 'config.json')
+
+def has_bounds(config):
+    """Whether a config carries the scene bounds the emission and fusion steps need"""
+    return all(k in config for k in ('min_lat', 'max_lat', 'min_lon', 'max_lon'))
+
+def session_folder(sid):
+    name = Path(sid).name
+    if name in ('', '.', '..'):
+        return None
+    folder = UPLOAD_FOLDER / name
+    return folder if folder.is_dir() else None
+
+# Offline reprocessing
+# Backfills over months of persisted uploads open every band memory-mapped, so only
+# the scenes of the batch being preprocessed are ever paged in.
+class SceneStore:
+    """Index of the saved sessions under folder that still have their band_XX.npy inputs"""
+    def __init__(self, folder=UPLOAD_FOLDER):
+        self.folder = Path(folder)
+        self.index = {}
+        if self.folder.is_dir():
+            for session in sorted(self.folder.iterdir()):
+                try:
+                    bands = self.open(session.name)
+                except (OSError, ValueError):
+                    continue
+                if bands is not None:
+                    self.index[session.name] = bands[0].shape
+
+    def __len__(self):
+        return len(self.index)
+
+    def open(self, sid):
+        """Memory-mapped (b11, b14, b15) of a session, or None when its inputs were not kept"""
+        paths = [self.folder / sid / f'band_{b}.npy' for b in ('11', '14', '15')]
+        if not all(p.is_file() for p in paths):
+            return None
+        bands = [np.load(p, mmap_mode='r') for p in paths]
+        if bands[0].ndim != 3 or not (bands[0].shape == bands[1].shape == bands[2].shape):
+            raise ValueError(f'Session {sid} has mismatched band shapes')
+        return bands
+
+    def batches(self, batch_size=BATCH_MAX_SIZE, sids=None):
+        """Yield (session_ids, (N, C, H, W) tensor) with sessions of equal shape batched together.
+        Each batch is preprocessed straight from the memory-mapped bands into a fresh buffer."""
+        groups = {}
+        for sid in (self.index if sids is None else sids):
+            groups.setdefault(self.index[sid], []).append(sid)
+        for (h, w, t), group in groups.items():
+            # scenes that are tiled anyway go one at a time to bound memory
+            size = batch_size if (h, w) == (TILE_SIZE, TILE_SIZE) else 1
+            for start in range(0, len(group), size):
+                chunk = group[start:start + size]
+                batch = np.empty((len(chunk), 3 * t, h, w), dtype=np.float32)
+                for k, sid in enumerate(chunk):
+                    process_data(*self.open(sid), out=batch[k])
+                yield chunk, torch.from_numpy(batch)
+
+def reprocess(store, out_folder, thresh=0.5, batch_size=BATCH_MAX_SIZE, sids=None):
+    """Run the current model over stored sessions, writing <sid>.npz (prob, binary) into out_folder.
+    Yields (session_id, contrail stats) as each scene finishes."""
+    out_folder = Path(out_folder)
+    out_folder.mkdir(parents=True, exist_ok=True)
+    for chunk, imgs in store.batches(batch_size, sids):
+        if tuple(imgs.shape[-2:]) == (TILE_SIZE, TILE_SIZE):
+            # one forward pass per batch, so batch_size is also the model batch size
+            probs = predict(imgs)
+        else:
+            probs = [predict_tiled(img) for img in imgs]
+        for sid, prob in zip(chunk, probs):
+            binary = (prob > thresh).astype(np.uint8)
+            np.savez_compressed(out_folder / f'{sid}.npz', prob=prob.astype(np.float16), binary=binary)
+            yield sid, contrail_stats(prob, binary)
+
+def clear_session_images(folder):
+    """Delete every rendered image variant of a session whose arrays were rewritten"""
+    for kind in IMAGE_KINDS:
+        for p in folder.glob(f'{kind}.*'):
+            if p.suffix in ('.png', '.webp'):
+                p.unlink(missing_ok=True)
+
+def ensure_image(folder, kind, overrides=None):
+    """Return the path of a session image, rendering and caching it on first access.
+    Image options come from the session config unless overridden."""
+    with open(folder / 'config.json', 'r', encoding='utf-8') as f:
+        config = {**json.load(f), **(overrides or {})}
+    path = folder / image_filename(kind, image_options(config))
+    if path.exists():
+        return path
+    with _render_locks_guard:
+        lock = _render_locks.setdefault(str(path), threading.Lock())
+    with lock:
+        if path.exists():
+            return path
+        rgb = np.load(folder / 'input_rgb.npy')
+        prob = np.load(folder / 'prob.npy')
+        binary = np.load(folder / 'binary.npy')
+        # input_rgb() reads channels t, 8+t and 16+t, so a 24-channel stand-in rebuilds the input image
+        fc = np.zeros((*rgb.shape[:2], 24), dtype=np.float32)
+        fc[:, :, [3, 11, 19]] = rgb
+        # Render in a private folder and move into place so other workers never see a partial file
+        tmp = folder / f'.render-{os.getpid()}-{threading.get_ident()}'
+        tmp.mkdir(exist_ok=True)
+        try:
+            os.replace(render_image(kind, fc, prob, binary, config, tmp), path)
+        finally:
+            for f in tmp.iterdir():
+                f.unlink()
+            tmp.rmdir()
+    return path
+
+# Tile pyramid
+# XYZ tiles of a session's arrays for pan/zoom over large scenes. The deepest zoom
+# shows native pixels; each level above is a 2x2 reduction of the one below (max for
+# the masks so thin contrails stay visible, mean for the input image), built lazily.
+# Rendered tiles are kept in an LRU of PNG bytes.
+TILE_PX = 256
+TILE_LAYERS = ('probability', 'binary', 'input', 'overlay')
+TILE_CACHE_MB = float(os.environ.get('TILE_CACHE_MB', 64))
+PYRAMID_CACHE_SIZE = 4
+
+class TilePyramid:
+    """Zoom levels of one session's arrays, memory-mapped at full resolution"""
+    def __init__(self, folder):
+        self.base = {'probability': np.load(folder / 'prob.npy', mmap_mode='r'),
+                     'binary': np.load(folder / 'binary.npy', mmap_mode='r'),
+                     'input': np.load(folder / 'input_rgb.npy', mmap_mode='r')}
+        self.height, self.width = self.base['probability'].shape
+        self.max_zoom = max(0, int(np.ceil(np.log2(max(self.height, self.width) / TILE_PX))))
+        self.levels = {}
+        self.lock = threading.Lock()
+
+    def info(self):
+        return {'width': self.width, 'height': self.height, 'tile_size': TILE_PX,
+                'min_zoom': 0, 'max_zoom': self.max_zoom, 'layers': list(TILE_LAYERS)}
+
+    def level(self, name, z):
+        if z == self.max_zoom:
+            return self.base[name]
+        with self.lock:
+            arr = self.levels.get((name, z))
+        if arr is None:
+            below = self.level(name, z + 1)
+            h, w = below.shape[:2]
+            # edge-pad odd sizes so the 2x2 blocks line up
+            padded = np.pad(below, ((0, h % 2), (0, w % 2)) + ((0, 0),) * (below.ndim - 2), mode='edge')
+            blocks = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2, *padded.shape[2:])
+            arr = blocks.mean(axis=(1, 3)) if name == 'input' else blocks.max(axis=(1, 3))
+            with self.lock:
+                self.levels[(name, z)] = arr
+        return arr
+
+    def tile(self, layer, z, x, y):
+        """(TILE_PX, TILE_PX, 4) RGBA tile, transparent outside the scene, or None off the grid"""
+        if not 0 <= z <= self.max_zoom:
+            return None
+        n = 1 << (self.max_zoom - z)
+        if not (0 <= x < -(-self.width // (TILE_PX * n)) and 0 <= y < -(-self.height // (TILE_PX * n))):
+            return None
+        out = np.zeros((TILE_PX, TILE_PX, 4), dtype=np.uint8)
+        region = (slice(y * TILE_PX, (y + 1) * TILE_PX), slice(x * TILE_PX, (x + 1) * TILE_PX))
+        if layer == 'probability':
+            data = self.level('probability', z)[region]
+            rgb = colormap_lut('hot')[np.clip(data * 255, 0, 255).astype(np.uint8)]
+        elif layer == 'binary':
+            rgb = np.repeat(self.level('binary', z)[region][:, :, None] * 255, 3, axis=2).astype(np.uint8)
+        elif layer == 'input':
+            rgb = colorize(self.level('input', z)[region])
+        else:
+            # Red contrail mask for stacking over the input layer, like the fusion map
+            mask = self.level('binary', z)[region] > 0
+            out[:mask.shape[0], :mask.shape[1]][mask] = (255, 0, 0, 128)
+            return out
+        out[:rgb.shape[0], :rgb.shape[1], :3] = rgb
+        out[:rgb.shape[0], :rgb.shape[1], 3] = 255
+        return out
+
+class TileCache:
+    """LRU of encoded tiles plus the pyramids of the most recently viewed sessions"""
+    def __init__(self, max_bytes):
+        self.tiles = LRUCache(max_bytes)
+        self.pyramids = LRUCache(PYRAMID_CACHE_SIZE, sizeof=lambda pyramid: 1)
+
+    def pyramid(self, folder):
+        # prob.npy is rewritten when a scene is reanalyzed, so its mtime is part of the key
+        key = (str(folder), (folder / 'prob.npy').stat().st_mtime_ns)
+        pyramid = self.pyramids.get(key)
+        if pyramid is None:
+            pyramid = self.pyramids.put(key, TilePyramid(folder))
+        return pyramid, key
+
+    def get(self, folder, layer, z, x, y):
+        """PNG bytes and cache key of a tile, or None when it is off the grid"""
+        pyramid, version = self.pyramid(folder)
+        key = (*version, layer, z, x, y)
+        data = self.tiles.get(key)
+        if data is not None:
+            return data, key
+        rgba = pyramid.tile(layer, z, x, y)
+        if rgba is None:
+            return None, key
+        buf = io.BytesIO()
+        Image.fromarray(rgba, 'RGBA').save(buf, format='PNG', compress_level=1)
+        return self.tiles.put(key, buf.getvalue()), key
+
+tile_cache = TileCache(TILE_CACHE_MB * 2**20)
+
+# Analysis pipeline
+# Stages are yielded in the order their results become available:
+# contrail -> emission -> strategies -> one 'image' per IMAGE_KINDS entry
+IMAGE_KINDS = ['input', 'probability', 'binary', 'fusion']
+ANALYSIS_STEPS = 3 + len(IMAGE_KINDS)
+
+def iter_analysis(sid, folder, config, bands=None):
+    """Run the analysis for a session, yielding (stage, payload) as each part is ready.
+    Bands are read from the session folder unless passed in."""
+    if bands is None:
+        bands = [np.load(folder / f'band_{b}.npy') for b in ('11', '14', '15')]
+    encodings = mask_options(config)
+    image_format = image_options(config)['format']
+    img, fc = process_data(*bands)
+    options = prefilter_options(config)
+    screen = prescreen(fc, options) if options else None
+    if screen and screen['skipped']:
+        prob = np.zeros(fc.shape[:2], dtype=np.float32)
+        binary = np.zeros(fc.shape[:2], dtype=np.uint8)
+    else:
+        prob, binary = detect_cached(scene_key(*bands), img, config.get('threshold', 0.5))
+    save_session_arrays(folder, input_rgb(fc), prob, binary, config)
+    contrail = contrail_stats(prob, binary)
+    if screen:
+        contrail['prefilter'] = screen
+    yield 'contrail', contrail
+
+    # Images render in the background while the rest of the response is computed
+    renders = {}
+    if config.get('images') != 'url':
+        renders = {render_executor.submit(render_image, kind, fc, prob, binary, config, folder): kind
+                   for kind in IMAGE_KINDS}
+
+    if encodings:
+        yield 'masks', mask_summary(prob, binary, config, encodings)
+
+    em, cb = calc_emission(config, binary)
+    yield 'emission', emission_summary(config, em, cb)
+
+    yield 'strategies', carbon_strategies(em)
+
+    if not renders:
+        for kind in IMAGE_KINDS:
+            # Rendered on first access by /api/sessions/<sid>/images/<kind>
+            yield 'image', {'kind': kind, 'url': f'/api/sessions/{sid}/images/{kind}'}
+    for future in as_completed(renders):
+        yield 'image', {'kind': renders[future], 'format': image_format, 'data': encode_image(future.result())}
+
+def run_analysis(sid, folder, config, progress=None, bands=None):
+    """Run the whole pipeline and assemble the /api/analyze response"""
+    result = {'session_id': sid, 'images': {}}
+    for stage, data in iter_analysis(sid, folder, config, bands):
+        if stage == 'image':
+            result['images'][data['kind']] = data.get('data', data.get('url'))
+            result['image_format'] = data.get('format', result.get('image_format'))
+        elif stage == 'emission':
+            result.update(data)
+        else:
+            result[stage] = data
+        if progress:
+            progress(stage, data)
+    result['report'] = f'Analysis completed for {sid}'
+    return result
+
+# Background jobs
+# Job state lives in <session>/job.json so any gunicorn worker can answer a poll,
+# while the work itself runs on this process's JOB_WORKERS thread pool.
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='analysis-job')
+
+def write_job(folder, job):
+    tmp = folder / 'job.json.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(job, f)
+    os.replace(tmp, folder / 'job.json')
+
+def get_job(job_id):
+    path = UPLOAD_FOLDER / Path(job_id).name / 'job.json'
+    if not path.exists():
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def submit_job(sid, folder, config, bands=None):
+    job = {'job_id': sid, 'status': 'queued', 'stage': None, 'progress': 0.0,
+           'stages': {'contrail': 'pending', 'emission': 'pending', 'strategies': 'pending',
+                      **{f'image:{kind}': 'pending' for kind in IMAGE_KINDS}},
+           'created': datetime.now().isoformat(), 'result': None, 'error': None}
+    write_job(folder, job)
+    job_executor.submit(run_job, sid, folder, config, job, bands)
+    return job
+
+def run_job(sid, folder, config, job, bands=None):
+    job['status'] = 'running'
+    write_job(folder, job)
+
+    def progress(stage, data):
+        key = f"image:{data['kind']}" if stage == 'image' else stage
+        job['stages'][key] = 'done'
+        job['stage'] = key
+        done = sum(1 for v in job['stages'].values() if v == 'done')
+        job['progress'] = round(done / (ANALYSIS_STEPS + bool(config.get('mask_encodings'))), 3)
+        write_job(folder, job)
+
+    try:
+        job['result'] = run_analysis(sid, folder, config, progress, bands)
+        job['status'] = 'done'
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        job['status'] = 'error'
+        job['error'] = str(e)
+    job['finished'] = datetime.now().isoformat()
+    write_job(folder, job)
+
+# Model preloading
+# PRELOAD_MODEL=1 loads the model and runs one warm-up forward pass at import time.
+# Under `gunicorn --preload` (see Procfile) that happens once in the master, so forked
+# workers share the weight pages copy-on-write and no user request pays the load.
+PRELOAD_MODEL = os.environ.get('PRELOAD_MODEL', '0').lower() in ('1', 'true', 'yes')
+
+def warmup_model():
+    m = load_model()
+    # Moves parameters into shared memory; frozen TorchScript graphs keep their weights
+    # as graph constants instead and are shared through copy-on-write alone
+    m.share_memory()
+    t = time.time()
+    predict(torch.zeros(1, 24, TILE_SIZE, TILE_SIZE))
+    print(f"Model warmed up in {time.time() - t:.2f}s")
+
+# Spawned helper processes (scene and figure pools) import this module too; they skip it
+if PRELOAD_MODEL and not INFERENCE_SERVER and multiprocessing.current_process().name == 'MainProcess':
+    warmup_model()
+
+# Frame monitoring
+# For continuous monitoring a client posts one GOES frame at a time. Each frame is
+# normalized once and kept in a per-stream ring of the last MONITOR_FRAMES frames on
+# disk (so any gunicorn worker can serve the next frame); once the ring is full every
+# new frame triggers inference on the assembled 8-step window.
+MONITOR_FRAMES = 8
+MONITOR_FOLDER = RESULTS_FOLDER / 'monitor'
+_monitor_locks = {}
+_monitor_locks_guard = threading.Lock()
+
+def monitor_folder(stream_id):
+    name = Path(stream_id).name
+    if name in ('', '.', '..'):
+        return None
+    return MONITOR_FOLDER / name
+
+def push_frames(stream_id, b11, b14, b15):
+    """Normalize and store frames (H, W) or (H, W, T), returning the current window as (24, H, W) or None"""
+    folder = monitor_folder(stream_id)
+    if folder is None:
+        raise ValueError(f'Invalid stream id {stream_id!r}')
+    folder.mkdir(parents=True, exist_ok=True)
+    if b11.ndim == 2:
+        b11, b14, b15 = b11[:, :, None], b14[:, :, None], b15[:, :, None]
+    with _monitor_locks_guard:
+        lock = _monitor_locks.setdefault(folder.name, threading.Lock())
+    with lock:
+        existing = sorted(folder.glob('frame_*.npy'))
+        seq = int(existing[-1].stem.split('_')[1]) + 1 if existing else 0
+        if existing and np.load(existing[-1], mmap_mode='r').shape[1:] != b11.shape[:2]:
+            raise ValueError(f'Frame size {b11.shape[:2]} does not match stream {stream_id}')
+        for t in range(b11.shape[2]):
+            # (3, H, W): this frame's r, g, b false-color channels
+            frame = process_data(b11[:, :, t:t + 1], b14[:, :, t:t + 1], b15[:, :, t:t + 1])[0].numpy()
+            np.save(folder / f'frame_{seq:08d}.npy', frame)
+            seq += 1
+        frames = sorted(folder.glob('frame_*.npy'))
+        for old in frames[:-MONITOR_FRAMES]:
+            old.unlink()
+        frames = frames[-MONITOR_FRAMES:]
+        if len(frames) < MONITOR_FRAMES:
+            return None, len(frames)
+        window = np.stack([np.load(f) for f in frames], axis=1)  # (3, T, H, W)
+    # Model channel order is r0..r7, g0..g7, b0..b7
+    return torch.from_numpy(window.reshape(3 * MONITOR_FRAMES, *window.shape[2:])), len(frames)
+
+# Result downloads
+# The session archive is streamed to the client while it is written, so nothing is
+# staged under backend/results. Already-compressed files are stored, the rest deflated.
+# Archives up to DOWNLOAD_CACHE_MB in total are kept in memory and reused for as long as
+# the folder signature (names, sizes, mtimes) is unchanged; the signature is also the ETag.
+DOWNLOAD_CACHE_MB = float(os.environ.get('DOWNLOAD_CACHE_MB', 64))
+STORED_SUFFIXES = {'.png', '.webp', '.npz', '.zip', '.gz'}
+
+def session_files(folder):
+    """Files of a session in archive order, skipping hidden temp files"""
+    return sorted(p for p in folder.rglob('*')
+                  if p.is_file() and not any(part.startswith('.') for part in p.relative_to(folder).parts))
+
+def folder_signature(folder, files):
+    h = hashlib.sha256()
+    for p in files:
+        st = p.stat()
+        h.update(f'{p.relative_to(folder).as_posix()}:{st.st_size}:{st.st_mtime_ns};'.encode())
+    return h.hexdigest()[:32]
+
+class ZipSink(io.RawIOBase):
+    """Unseekable sink for zipfile that hands back whatever has been written so far"""
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.offset += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.offset
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def iter_zip(folder, files, chunk_size=1 << 20):
+    """Yield a zip archive of files (named relative to folder) as it is written"""
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, 'w') as z:
+        for path in files:
+            info = zipfile.ZipInfo.from_file(path, path.relative_to(folder).as_posix())
+            info.compress_type = zipfile.ZIP_STORED if path.suffix in STORED_SUFFIXES else zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, z.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dst.write(chunk)
+                    if sink.offset and sum(map(len, sink.chunks)) >= chunk_size:
+                        yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+class DownloadCache(LRUCache):
+    """Byte-bounded LRU of finished archives keyed by session and folder signature"""
+    def put(self, key, data):
+        # an older signature of the same session is never served again
+        self.discard(lambda k: k[0] == key[0] and k != key)
+        return super().put(key, data)
+
+    def stream(self, key, folder, files):
+        """Stream a fresh archive, keeping a copy if it turns out small enough to cache"""
+        parts, size = [], 0
+        for data in iter_zip(folder, files):
+            if data:
+                if parts is not None:
+                    parts.append(data)
+                    size += len(data)
+                    if size > self.max_size:
+                        parts = None
+                yield data
+        if parts is not None:
+            self.put(key, b''.join(parts))
+
+download_cache = DownloadCache(DOWNLOAD_CACHE_MB * 2**20)
+
 # Routes
 @app.route('/')
 def home():
@@ -271,138 +1990,317 @@ def favicon():
 
 @app.route('/api/health')
 def health():
-    return jsonify({'status': 'ok', 'device': str(device)})
+    if INFERENCE_SERVER:
+        try:
+            return jsonify({'status': 'ok', 'inference_server': INFERENCE_SERVER, **inference_client.call('info'),
+                            'cache': prob_cache.stats(), 'prefilter': prefilter_stats})
+        except (OSError, EOFError, RuntimeError) as e:
+            return jsonify({'status': 'degraded', 'inference_server': INFERENCE_SERVER, 'error': str(e)}), 503
+    return jsonify({'status': 'ok', 'device': str(device), 'model': model_info, 'batching': batcher.stats(),
+                    'cache': prob_cache.stats(), 'prefilter': prefilter_stats})
 
 @app.route('/api/analyze', methods=['POST'])
 def analyze():
     try:
-        b11 = request.files['band11']
-        b14 = request.files['band14']
-        b15 = request.files['band15']
         config = json.loads(request.form['config'])
 
-        sid = datetime.now().strftime('%Y%m%d_%H%M%S')
+        sid = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
         folder = UPLOAD_FOLDER / sid
         folder.mkdir(exist_ok=True)
 
-        p11 = folder / 'band_11.npy'
-        p14 = folder / 'band_14.npy'
-        p15 = folder / 'band_15.npy'
-        b11.save(p11)
-        b14.save(p14)
-        b15.save(p15)
+        bands = read_upload_bands(request.files, folder, config)
 
-        img, fc = process_data(np.load(p11), np.load(p14), np.load(p15))
-        prob, binary = detect(img, config.get('threshold', 0.5))
+        if request.args.get('async', '').lower() in ('1', 'true', 'yes'):
+            submit_job(sid, folder, config, bands)
+            return jsonify({'job_id': sid, 'session_id': sid, 'status': 'queued',
+                            'status_url': f'/api/jobs/{sid}'}), 202
+
+        return jsonify(run_analysis(sid, folder, config, bands=bands))
+    except Exception as e:
+        import traceback
+        print("="*60)
+        print("ERROR in /api/analyze:")
+        print(str(e))
+        print("="*60)
+        traceback.print_exc()
+        print("="*60)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """Same input as /api/analyze, but results are streamed stage by stage as they finish.
+    Default is Server-Sent Events; ?format=ndjson sends one JSON object per line instead."""
+    try:
+        config = json.loads(request.form['config'])
+        sid = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        folder = UPLOAD_FOLDER / sid
+        folder.mkdir(exist_ok=True)
+        bands = read_upload_bands(request.files, folder, config)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+    ndjson = request.args.get('format') == 'ndjson'
 
-        pixels = int(np.sum(binary))
-        coverage = float(pixels / (256 * 256) * 100)
-        area = float(pixels * 4)
-        intensity = float(np.mean(prob[binary > 0])) if pixels > 0 else 0.0
-
-        # Generate individual visualization images
-        visualize(fc, prob, binary, folder)
-
-        # Generate fusion visualization
-        fusion_path = folder / 'fusion.png'
-        visualize_fusion(fc, binary, config, fusion_path)
-
-        # Calculate emissions
-        em, cb = calc_emission(config, binary)
-
-        # Encode images to base64
-        def encode_image(path):
-            with open(path, 'rb') as f:
-                return base64.b64encode(f.read()).decode()
-
-        print(f"DEBUG: Encoding images from {folder}")
-        img_input = encode_image(folder / 'input.png')
-        print(f"DEBUG: img_input encoded: {len(img_input)} chars")
-        img_prob = encode_image(folder / 'probability.png')
-        print(f"DEBUG: img_prob encoded: {len(img_prob)} chars")
-        img_binary = encode_image(folder / 'binary.png')
-        print(f"DEBUG: img_binary encoded: {len(img_binary)} chars")
-        img_fusion = encode_image(fusion_path)
-        print(f"DEBUG: img_fusion encoded: {len(img_fusion)} chars")
-
-        # Calculate carbon trading strategies for different markets and altitudes
-        print("DEBUG: Starting strategy calculation...")
-        markets = ['EU_ETS', 'CORSIA', 'CHINA', 'UK_ETS', 'CALIFORNIA']
-        altitudes = [8000, 9000, 10000, 11000, 12000]  # meters
-
-        strategies = []
+    def event(stage, data):
+        if ndjson:
+            return json.dumps({'event': stage, 'data': data}) + '\n'
+        return f'event: {stage}\ndata: {json.dumps(data)}\n\n'
+
+    def generate():
+        yield event('session', {'session_id': sid})
         try:
-            for market in markets:
-                print(f"DEBUG: Processing market {market}...")
-                ct = CarbonTradingCalculator(market)
-                print(f"DEBUG: Created CarbonTradingCalculator for {market}, price={ct.carbon_price}")
-                market_data = {'market': market, 'price': ct.carbon_price, 'altitudes': []}
-
-                for alt in altitudes:
-                    # Simulate altitude impact (higher altitude = more contrail, more CO2eq)
-                    altitude_factor = 1.0 + (alt - 10000) / 10000 * 0.3
-                    adjusted_co2 = em.co2_total * altitude_factor
-                    cost_result = ct.calculate_flight_carbon_cost(adjusted_co2, em.flight_distance, 180)
-
-                    market_data['altitudes'].append({
-                        'altitude': alt,
-                        'co2_total': round(adjusted_co2, 1),
-                        'cost_total': round(cost_result.carbon_cost_total, 2),
-                        'cost_per_km': round(cost_result.carbon_cost_per_km, 4)
-                    })
-
-                strategies.append(market_data)
-                print(f"DEBUG: Completed market {market}")
+            for stage, data in iter_analysis(sid, folder, config, bands):
+                yield event(stage, data)
+            yield event('done', {'session_id': sid, 'report': f'Analysis completed for {sid}'})
         except Exception as e:
-            print(f"DEBUG ERROR in strategy calculation: {e}")
             import traceback
             traceback.print_exc()
-            raise
-
-        print(f"DEBUG: Prepared {len(strategies)} strategies")
-        print(f"DEBUG: Returning response with images and strategies")
-
-        return jsonify({
-            'session_id': sid,
-            'contrail': {'pixels': pixels, 'coverage': round(coverage, 2), 'area': round(area, 1), 'intensity': round(intensity, 2)},
-            'emission': {'distance': round(em.flight_distance, 1), 'fuel': round(em.fuel_burn, 1),
-                        'co2_direct': round(em.co2_direct, 1), 'co2_contrail': round(em.co2_contrail, 1),
-                        'co2_total': round(em.co2_total, 1)},
-            'carbon': {'market': config.get('carbon_market', 'EU_ETS'), 'price': cb.carbon_price_per_tonne,
-                      'cost_total': round(cb.carbon_cost_total, 2), 'cost_per_km': round(cb.carbon_cost_per_km, 4),
-                      'cost_per_passenger': round(cb.carbon_cost_per_passenger, 2)},
-            'flight': {'callsign': config.get('flight_callsign', 'UNKNOWN'), 'aircraft': 'A320',
-                      'time': config.get('detection_time', datetime.now().isoformat())},
-            'images': {
-                'input': img_input,
-                'probability': img_prob,
-                'binary': img_binary,
-                'fusion': img_fusion
-            },
-            'strategies': strategies,
-            'report': f'Analysis completed for {sid}'
-        })
+            yield event('error', {'error': str(e)})
+
+    mimetype = 'application/x-ndjson' if ndjson else 'text/event-stream'
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/sessions/<sid>/images/<kind>')
+def session_image(sid, kind):
+    folder = session_folder(sid)
+    if folder is None or kind not in IMAGE_KINDS or not (folder / 'prob.npy').exists():
+        return jsonify({'error': 'Not found'}), 404
+    if kind == 'fusion':
+        # Chunked scenes analyzed without bounds have no fusion map
+        with open(folder / 'config.json', 'r', encoding='utf-8') as f:
+            if not has_bounds(json.load(f)):
+                return jsonify({'error': 'Not found'}), 404
+    # ?profile=, ?format=, ?quality= and ?compression= override the session's image options
+    params = {'profile': 'image_profile', 'format': 'image_format', 'quality': 'image_quality',
+              'compression': 'png_compression'}
+    overrides = {key: request.args[arg] for arg, key in params.items() if arg in request.args}
+    try:
+        path = ensure_image(folder, kind, overrides)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response = send_file(path, mimetype=f'image/{path.suffix[1:]}', etag=True,
+                         conditional=True, max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    return response
+
+@app.route('/api/sessions/<sid>/tiles')
+def session_tiles(sid):
+    folder = session_folder(sid)
+    if folder is None or not (folder / 'prob.npy').exists():
+        return jsonify({'error': 'Not found'}), 404
+    pyramid, _ = tile_cache.pyramid(folder)
+    return jsonify({**pyramid.info(), 'url': f'/api/sessions/{sid}/tiles/{{z}}/{{x}}/{{y}}.png?layer={{layer}}'})
+
+@app.route('/api/sessions/<sid>/tiles/<int:z>/<int:x>/<int:y>.png')
+def session_tile(sid, z, x, y):
+    layer = request.args.get('layer', 'probability')
+    folder = session_folder(sid)
+    if folder is None or layer not in TILE_LAYERS or not (folder / 'prob.npy').exists():
+        return jsonify({'error': 'Not found'}), 404
+    data, key = tile_cache.get(folder, layer, z, x, y)
+    if data is None:
+        return jsonify({'error': 'Tile outside the scene'}), 404
+    response = send_file(io.BytesIO(data), mimetype='image/png', conditional=True, max_age=IMAGE_MAX_AGE,
+                         etag=hashlib.sha1(repr(key).encode()).hexdigest())
+    response.cache_control.public = True
+    return response
+
+@app.route('/api/jobs/<job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(job)
+
+def load_batch_scenes(req):
+    """Read (band11, band14, band15) triplets from a stacked .npz or repeated band fields"""
+    if 'scenes' in req.files:
+        with np.load(req.files['scenes'].stream) as npz:
+            b11, b14, b15 = npz['band11'], npz['band14'], npz['band15']
+        if not (b11.shape == b14.shape == b15.shape) or b11.ndim != 4:
+            raise ValueError('scenes.npz must hold band11/band14/band15 arrays of shape (N, H, W, T)')
+        return list(zip(b11, b14, b15))
+    files = [req.files.getlist(k) for k in ('band11', 'band14', 'band15')]
+    if not files[0] or not (len(files[0]) == len(files[1]) == len(files[2])):
+        raise ValueError('Expected the same number of band11, band14 and band15 files')
+    return [tuple(read_band(f.stream) for f in triplet) for triplet in zip(*files)]
+
+@app.route('/api/analyze/batch', methods=['POST'])
+def analyze_batch():
+    try:
+        scenes = load_batch_scenes(request)
+        configs = json.loads(request.form['config'])
+        if isinstance(configs, dict):
+            configs = [configs] * len(scenes)
+        if len(configs) != len(scenes):
+            return jsonify({'error': f'Got {len(configs)} configs for {len(scenes)} scenes'}), 400
+
+        sid = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        folder = UPLOAD_FOLDER / sid
+        folder.mkdir(exist_ok=True)
+
+        keys = [scene_key(*scene) for scene in scenes]
+        probs = [prob_cache.get(key) for key in keys]
+        screens = [None] * len(scenes)
+        misses, imgs = [], []
+        for i, prob in enumerate(probs):
+            if prob is not None:
+                continue
+            img, fc = process_data(*scenes[i])
+            options = prefilter_options(configs[i])
+            screens[i] = prescreen(fc, options) if options else None
+            if screens[i] and screens[i]['skipped']:
+                probs[i] = np.zeros(fc.shape[:2], dtype=np.float32)
+            else:
+                misses.append(i)
+                imgs.append(img)
+        for i, prob in zip(misses, predict_many(imgs)):
+            probs[i] = prob_cache.put(keys[i], prob)
+
+        results = []
+        for i, (config, prob) in enumerate(zip(configs, probs)):
+            binary = (prob > config.get('threshold', 0.5)).astype(np.uint8)
+            em, cb = calc_emission(config, binary)
+            contrail = contrail_stats(prob, binary)
+            if screens[i]:
+                contrail['prefilter'] = screens[i]
+            results.append({'index': i, 'contrail': contrail, **emission_summary(config, em, cb)})
+
+        with open(folder / 'results.json', 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+        return jsonify({'session_id': sid, 'count': len(results), 'results': results})
     except Exception as e:
         import traceback
         print("="*60)
-        print("ERROR in /api/analyze:")
+        print("ERROR in /api/analyze/batch:")
         print(str(e))
         print("="*60)
         traceback.print_exc()
         print("="*60)
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/monitor/<stream_id>/frames', methods=['POST'])
+def monitor_frame(stream_id):
+    if monitor_folder(stream_id) is None:
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        bands = [read_band(request.files[f'band{b}'].stream) for b in ('11', '14', '15')]
+        config = json.loads(request.form.get('config', '{}'))
+        img, count = push_frames(stream_id, *bands)
+        if img is None:
+            return jsonify({'stream_id': stream_id, 'frames': count, 'ready': False})
+
+        prob, binary = detect(img, config.get('threshold', 0.5))
+        result = {'stream_id': stream_id, 'frames': count, 'ready': True, 'contrail': contrail_stats(prob, binary)}
+        if all(k in config for k in ('min_lat', 'max_lat', 'min_lon', 'max_lon')):
+            em, cb = calc_emission(config, binary)
+            result.update(emission_summary(config, em, cb))
+        return jsonify(result)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/monitor/<stream_id>', methods=['DELETE'])
+def monitor_reset(stream_id):
+    folder = monitor_folder(stream_id)
+    if folder is None:
+        return jsonify({'error': 'Not found'}), 404
+    for f in folder.glob('frame_*.npy'):
+        f.unlink()
+    return jsonify({'stream_id': stream_id, 'frames': 0})
+
+@app.route('/api/scenes', methods=['POST'])
+def create_scene():
+    """Create a chunked scene, either from uploaded band files or empty from a JSON
+    {"shape": [H, W, T], "dtype": ..., "chunk": ...} description to be filled chunk by chunk"""
+    try:
+        sid = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+        folder = UPLOAD_FOLDER / sid
+        folder.mkdir(exist_ok=True)
+        if request.files:
+            chunk = int(request.form.get('chunk', TILE_SIZE))
+            bands = read_upload_bands(request.files, folder, {'persist_inputs': False})
+            if not (bands[0].shape == bands[1].shape == bands[2].shape):
+                raise ValueError('band11, band14 and band15 must have the same shape')
+            stores = [ChunkStore.from_array(folder / f'band_{b}', arr, chunk) for b, arr in zip(('11', '14', '15'), bands)]
+        else:
+            meta = request.get_json()
+            stores = [ChunkStore.create(folder / f'band_{b}', meta['shape'], meta.get('dtype', 'float32'),
+                                        meta.get('chunk', TILE_SIZE)) for b in ('11', '14', '15')]
+        return jsonify({'scene_id': sid, 'shape': stores[0].shape, 'dtype': stores[0].dtype.name,
+                        'chunk': stores[0].chunk, 'grid': stores[0].grid, 'missing': len(stores[0].missing()) * 3}), 201
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/scenes/<scene_id>/bands/<band>/chunks/<int:cy>/<int:cx>', methods=['PUT'])
+def put_scene_chunk(scene_id, band, cy, cx):
+    folder = session_folder(scene_id)
+    if folder is None or band not in ('11', '14', '15') or not (folder / f'band_{band}' / 'meta.json').exists():
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        store = ChunkStore(folder / f'band_{band}')
+        store.write_chunk(cy, cx, read_band(io.BytesIO(request.get_data())))
+        return jsonify({'scene_id': scene_id, 'band': band, 'chunk': [cy, cx], 'missing': len(store.missing())})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/scenes/<scene_id>/analyze', methods=['POST'])
+def analyze_scene(scene_id):
+    folder = session_folder(scene_id)
+    if folder is None or not (folder / 'band_11' / 'meta.json').exists():
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        config = request.get_json(silent=True) or json.loads(request.form.get('config', '{}'))
+        stores = scene_stores(folder)
+        missing = {f'band{b}': len(s.missing()) for b, s in zip(('11', '14', '15'), stores) if s.missing()}
+        if missing:
+            return jsonify({'error': 'Scene is missing chunks', 'missing': missing}), 409
+
+        prob = predict_stores(stores)
+        binary = (prob > config.get('threshold', 0.5)).astype(np.uint8)
+        h, w, _ = stores[0].shape
+        frame = [s.read(0, h, 0, w, t=3)[:, :, None] for s in stores]
+        save_session_arrays(folder, process_data(*frame)[1], prob, binary, config)
+        # a re-analysis must not keep serving images rendered from the previous arrays
+        clear_session_images(folder)
+
+        # the fusion map needs the scene bounds, so it is only offered when they are given
+        located = has_bounds(config)
+        kinds = [kind for kind in IMAGE_KINDS if located or kind != 'fusion']
+        result = {'scene_id': scene_id, 'session_id': scene_id, 'shape': [h, w], 'contrail': contrail_stats(prob, binary),
+                  'images': {kind: f'/api/sessions/{scene_id}/images/{kind}' for kind in kinds},
+                  'tiles': f'/api/sessions/{scene_id}/tiles'}
+        if located:
+            em, cb = calc_emission(config, binary)
+            result.update(emission_summary(config, em, cb))
+        return jsonify(result)
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/download/<sid>')
 def download(sid):
-    import zipfile
-    folder = UPLOAD_FOLDER / sid
-    if not folder.exists():
+    folder = session_folder(sid)
+    if folder is None:
         return jsonify({'error': 'Not found'}), 404
-    zp = RESULTS_FOLDER / f'{sid}.zip'
-    with zipfile.ZipFile(zp, 'w') as z:
-        for f in folder.iterdir():
-            z.write(f, f.name)
-    return send_file(zp, as_attachment=True, download_name=f'results_{sid}.zip')
+    files = session_files(folder)
+    signature = folder_signature(folder, files)
+    headers = {'Content-Disposition': f'attachment; filename=results_{sid}.zip'}
+    key = (sid, signature)
+    cached = download_cache.get(key)
+    if cached is not None:
+        response = Response(cached, mimetype='application/zip', headers=headers)
+    else:
+        response = Response(download_cache.stream(key, folder, files), mimetype='application/zip', headers=headers)
+    response.set_etag(signature)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/<path:path>')
 def static_files(path):
@@ -0,0 +1,72 @@
+"""
+TrailSyncPioneers - Standalone Inference Server
+Owns the UNet and the micro-batching queue for every web worker on the host.
+Run: python inference_server.py
+Then start the web process with INFERENCE_SERVER=<same address>
+"""
+
+import os
+import threading
+from multiprocessing.connection import Listener
+
+# This process is the server, never a client of another one
+os.environ.pop('INFERENCE_SERVER', None)
+
+import numpy as np
+import torch
+
+import app
+
+ADDRESS = os.environ.get('INFERENCE_SOCKET', 'backend/inference.sock')
+
+
+def handle(conn):
+    """Serve one web worker connection until it closes"""
+    with conn:
+        while True:
+            try:
+                op, payload = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if op == 'predict':
+                    imgs = torch.from_numpy(payload)
+                    if app.BATCH_MAX_SIZE > 1:
+                        # Items from all connections share the batcher, so concurrent
+                        # web workers end up in the same forward pass
+                        futures = [app.batcher.submit(img) for img in imgs]
+                        result = np.stack([f.result() for f in futures])
+                    else:
+                        result = app.predict(imgs)
+                elif op == 'info':
+                    info = app.model_info
+                    result = {'device': str(app.device), 'model': info, 'batching': app.batcher.stats(),
+                              # effective setup after any fallbacks, so web workers key their caches on it
+                              'identity': f"{app.model_version()}:{info['mode']}:{info['precision']}"}
+                else:
+                    raise ValueError(f'Unknown operation: {op}')
+                conn.send(('ok', result))
+            except Exception as e:
+                conn.send(('error', str(e)))
+
+
+def main():
+    address = app.parse_address(ADDRESS)
+    authkey = app.inference_authkey(ADDRESS)
+    if isinstance(address, str) and os.path.exists(address):
+        os.unlink(address)
+    app.warmup_model()
+    with Listener(address, authkey=authkey) as listener:
+        print(f"Inference server listening on {ADDRESS}")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # A client that fails authentication must not stop the server
+                print(f"Rejected connection: {e}")
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+if __name__ == '__main__':
+    main()
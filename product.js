@@ -31,8 +31,8 @@ function initializeFileUploads() {
             const file = e.target.files[0];
             if (file) {
                 // Validate file
-                if (!file.name.endsWith('.npy')) {
-                    status.textContent = '❌ Invalid file type. Please upload .npy file';
+                if (!file.name.endsWith('.npy') && !file.name.endsWith('.npz')) {
+                    status.textContent = '❌ Invalid file type. Please upload .npy or .npz file';
                     status.className = 'file-status error';
                     uploadedFiles[bandId] = null;
                     return;
@@ -390,7 +390,7 @@ function displayResults(results) {
             for (const [id, data] of Object.entries(imgElements)) {
                 const element = document.getElementById(id);
                 if (element && data) {
-                    element.src = 'data:image/png;base64,' + data;
+                    element.src = 'data:image/' + (results.image_format || 'png') + ';base64,' + data;
                     console.log(`Set image for ${id}, data length: ${data.length}`);
                 } else if (!element) {
                     console.warn(`Element with id '${id}' not found`);
@@ -0,0 +1,44 @@
+"""
+TrailSyncPioneers - Offline Reprocessing
+Re-runs the current model over every saved session that kept its band inputs.
+Run: python reprocess.py [--out DIR] [--threshold 0.5] [--batch-size 8] [--since YYYYMMDD]
+Writes <session_id>.npz (prob, binary) and a manifest.jsonl with contrail stats per scene.
+"""
+
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+# Backfills batch scenes themselves and run the model in this process
+os.environ.pop('INFERENCE_SERVER', None)
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reprocess saved sessions with the current model')
+    parser.add_argument('--uploads', default=str(app.UPLOAD_FOLDER))
+    parser.add_argument('--out', default=None, help='defaults to backend/results/reprocess/<model version>')
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=app.BATCH_MAX_SIZE, help='256x256 scenes per forward pass')
+    parser.add_argument('--since', default=None, help='only sessions whose id sorts at or after this prefix')
+    args = parser.parse_args()
+
+    store = app.SceneStore(args.uploads)
+    sids = [sid for sid in store.index if args.since is None or sid >= args.since]
+    out = Path(args.out or app.RESULTS_FOLDER / 'reprocess' / app.model_version())
+    print(f'Reprocessing {len(sids)} of {len(store)} stored sessions into {out}')
+
+    start = time.perf_counter()
+    out.mkdir(parents=True, exist_ok=True)
+    with open(out / 'manifest.jsonl', 'a', encoding='utf-8') as manifest:
+        for n, (sid, stats) in enumerate(app.reprocess(store, out, args.threshold, args.batch_size, sids), 1):
+            manifest.write(json.dumps({'session_id': sid, 'contrail': stats}) + '\n')
+            if n % 50 == 0 or n == len(sids):
+                print(f'{n}/{len(sids)} scenes, {n / (time.perf_counter() - start):.1f} scenes/s')
+
+
+if __name__ == '__main__':
+    main()